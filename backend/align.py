@@ -1,14 +1,36 @@
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from rapidfuzz import process
 from rapidfuzz.fuzz import token_set_ratio
 
 from models import Block, Line, Stream, SegmentSpan
+from text_norm import normalize_hebrew, normalize_whitespace
 
-def normalize_hebrew(text: str) -> str:
-    # Beta: simple whitespace normalization.
-    # TODO: add niqqud stripping and final-letter normalization.
-    return " ".join((text or "").strip().split())
+if TYPE_CHECKING:
+    from embeddings import EmbeddingRegistry
+
+def sorted_line_ids(lines: Dict[str, Line]) -> List[str]:
+    """All line ids in page reading order (by order_hint)."""
+    return sorted(lines, key=lambda lid: lines[lid].order_hint)
+
+def line_order_rank(
+    lines: Dict[str, Line], ordered_ids: Optional[List[str]] = None
+) -> Dict[str, int]:
+    """Page reading order computed once: line_id -> rank by order_hint (or from ordered_ids)."""
+    if ordered_ids is None:
+        ordered_ids = sorted_line_ids(lines)
+    return {lid: i for i, lid in enumerate(ordered_ids)}
+
+def _sort_line_ids(
+    line_ids: Iterable[str],
+    lines: Dict[str, Line],
+    line_rank: Optional[Dict[str, int]] = None,
+) -> List[str]:
+    if line_rank is not None:
+        return sorted(line_ids, key=line_rank.__getitem__)
+    return sorted(line_ids, key=lambda lid: lines[lid].order_hint)
 
 def score_text(a: str, b: str) -> float:
     if not a or not b:
@@ -17,6 +39,10 @@ def score_text(a: str, b: str) -> float:
     b_n = normalize_hebrew(b)
     return token_set_ratio(a_n, b_n) / 100.0
 
+def _token_set_text(text: str) -> str:
+    """Deduped, sorted tokens; token_set_ratio scores it the same as the original text."""
+    return " ".join(sorted(set(text.split())))
+
 def assign_blocks_to_streams(
     blocks: Dict[str, Block],
     lines: Dict[str, Line],
@@ -24,28 +50,51 @@ def assign_blocks_to_streams(
     thresh: float = 0.25,
     block_prefix_lines: int = 10,
     stream_prefix_segs: int = 3,
+    line_rank: Optional[Dict[str, int]] = None,
 ) -> Tuple[List[str], List[str]]:
-    stream_prefix: Dict[str, str] = {}
-    for sid, st in streams.items():
+    stream_ids = list(streams.keys())
+    stream_texts: List[str] = []
+    for st in streams.values():
         k = min(stream_prefix_segs, len(st.seg_texts))
-        stream_prefix[sid] = " ".join(st.seg_texts[:k])
+        stream_texts.append(_token_set_text(normalize_hebrew(" ".join(st.seg_texts[:k]))))
 
-    unknown: List[str] = []
+    # Block prefix texts for every non-Rashi block, scored against all streams in one cdist call
+    block_row: Dict[str, int] = {}
+    block_texts: List[str] = []
     for bid, blk in blocks.items():
         if getattr(blk, "font", None) == "rashi":
+            continue
+        line_ids = _sort_line_ids(blk.line_ids, lines, line_rank)
+        m = min(block_prefix_lines, len(line_ids))
+        block_text = " ".join([lines[lid].vlm_text or "" for lid in line_ids[:m]]).strip()
+        block_row[bid] = len(block_texts)
+        block_texts.append(_token_set_text(normalize_hebrew(block_text)))
+
+    # No score_cutoff: below-threshold blocks keep their real best score so reviewers can
+    # see near-misses
+    scores = None
+    if block_texts and stream_texts:
+        scores = process.cdist(
+            block_texts,
+            stream_texts,
+            scorer=token_set_ratio,
+            dtype=np.float64,
+            workers=-1,
+        ) / 100.0
+
+    unknown: List[str] = []
+    for bid, blk in blocks.items():
+        row = block_row.get(bid)
+        if row is None:
             blk.assigned_stream_id = None
             blk.assign_score = None
             unknown.append(bid)
             continue
-        line_ids = sorted(blk.line_ids, key=lambda lid: lines[lid].order_hint)
-        m = min(block_prefix_lines, len(line_ids))
-        block_text = " ".join([lines[lid].vlm_text or "" for lid in line_ids[:m]]).strip()
 
         best_sid, best_sc = None, -1.0
-        for sid, sp in stream_prefix.items():
-            sc = score_text(block_text, sp)
-            if sc > best_sc:
-                best_sid, best_sc = sid, sc
+        if scores is not None:
+            j = int(scores[row].argmax())
+            best_sid, best_sc = stream_ids[j], float(scores[row, j])
 
         if best_sid is None or best_sc < thresh:
             blk.assigned_stream_id = None
@@ -59,41 +108,108 @@ def assign_blocks_to_streams(
     unassigned = [sid for sid in streams.keys() if sid not in assigned]
     return unknown, unassigned
 
+def _stream_embedding_texts(
+    stream: Stream,
+    line_ids: List[str],
+    lines: Dict[str, Line],
+    line_rank: Optional[Dict[str, int]] = None,
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    (ordered line ids, line texts, segment texts) for main-text alignment. Only whitespace is
+    normalized: the model embeds real Hebrew; canonical folding is the cache's concern.
+    """
+    ordered = _sort_line_ids(set(line_ids), lines, line_rank)
+    line_texts = [normalize_whitespace(lines[lid].vlm_text or "") for lid in ordered]
+    seg_texts = [normalize_whitespace(t) for t in stream.seg_texts]
+    return ordered, line_texts, seg_texts
+
+
+def _commentary_segments(
+    streams: Dict[str, Stream],
+    main_stream_id: str,
+) -> List[Tuple[str, str, str]]:
+    """All commentary segments (stream_id, seg_ref, seg_text) across streams except main."""
+    seg_triples: List[Tuple[str, str, str]] = []
+    for sid, st in streams.items():
+        if sid == main_stream_id:
+            continue
+        for ref, text in zip(st.seg_refs, st.seg_texts):
+            seg_triples.append((sid, ref, (text or "").strip()))
+    return seg_triples
+
+
+def register_stream_embeddings(
+    registry: EmbeddingRegistry,
+    stream: Stream,
+    line_ids: List[str],
+    lines: Dict[str, Line],
+    line_rank: Optional[Dict[str, int]] = None,
+) -> None:
+    """Queue the texts align_segments_to_lines_for_stream_embeddings will embed."""
+    if not stream.seg_refs or not line_ids:
+        return
+    _, line_texts, seg_texts = _stream_embedding_texts(stream, line_ids, lines, line_rank)
+    registry.register_many(line_texts)
+    registry.register_many(seg_texts)
+
+
+def register_commentary_embeddings(
+    registry: EmbeddingRegistry,
+    commentary_spans: List[Tuple[str, str, str]],
+    streams: Dict[str, Stream],
+    main_stream_id: str,
+) -> None:
+    """Queue the texts match_commentary_spans_to_streams will embed."""
+    if not commentary_spans:
+        return
+    seg_triples = _commentary_segments(streams, main_stream_id)
+    if not seg_triples:
+        return
+    registry.register_many([t for _, _, t in commentary_spans])
+    registry.register_many([t for _, _, t in seg_triples])
+
+
 def align_segments_to_lines_for_stream_embeddings(
     stream: Stream,
     line_ids: List[str],
     lines: Dict[str, Line],
     window: int = 15,
     min_score: float = 0.30,
+    registry: Optional[EmbeddingRegistry] = None,
+    line_rank: Optional[Dict[str, int]] = None,
 ) -> List[SegmentSpan]:
     """
     Main-text alignment using OpenAI embeddings: for each segment find the contiguous
     line range that maximizes cosine similarity with the segment text.
+    Pass a page-level registry (see register_stream_embeddings) to share one embeddings call.
     """
-    from embeddings import get_embeddings, cosine_similarity
+    from embeddings import EmbeddingRegistry, l2_normalize
 
     if not stream.seg_refs or not line_ids:
         return []
-    ordered = sorted(set(line_ids), key=lambda lid: lines[lid].order_hint)
-    line_texts = [normalize_hebrew(lines[lid].vlm_text or "") for lid in ordered]
-    seg_texts = [normalize_hebrew(t) for t in stream.seg_texts]
-    line_emb = get_embeddings(line_texts)
-    seg_emb = get_embeddings(seg_texts)
+    ordered, line_texts, seg_texts = _stream_embedding_texts(stream, line_ids, lines, line_rank)
+    reg = registry if registry is not None else EmbeddingRegistry()
+    line_rows = reg.register_many(line_texts)
+    seg_rows = reg.register_many(seg_texts)
+    line_emb = reg.vectors(line_rows)
+    seg_emb = l2_normalize(reg.vectors(seg_rows))
+
+    # Prefix sums: sum of line embeddings in [p, q] is csum[q + 1] - csum[p]
+    n_lines, dim = line_emb.shape
+    csum = np.concatenate([np.zeros((1, dim), dtype=np.float32), line_emb.cumsum(axis=0)])
 
     spans: List[SegmentSpan] = []
     p = 0
     for seg_idx, (seg_ref, _) in enumerate(zip(stream.seg_refs, stream.seg_texts)):
         if p >= len(ordered):
             break
-        best_q, best_sc = None, -1.0
-        for q in range(p, min(len(ordered), p + window)):
-            # Aggregate embedding: mean of line embeddings in [p, q]
-            n = q - p + 1
-            mean_emb = [sum(line_emb[i][d] for i in range(p, q + 1)) / n for d in range(len(line_emb[0]))]
-            sc = cosine_similarity(mean_emb, seg_emb[seg_idx])
-            if sc > best_sc:
-                best_sc, best_q = sc, q
-        if best_q is None or best_sc < min_score:
+        # Aggregate embedding per candidate end q: mean of line embeddings in [p, q]
+        q_range = np.arange(p, min(n_lines, p + window))
+        means = (csum[q_range + 1] - csum[p]) / (q_range - p + 1)[:, None]
+        scores = l2_normalize(means) @ seg_emb[seg_idx]
+        k = int(scores.argmax())
+        best_q, best_sc = int(q_range[k]), float(scores[k])
+        if best_sc < min_score:
             spans.append(
                 SegmentSpan(
                     stream_id=stream.stream_id,
@@ -126,13 +242,15 @@ def align_segments_to_lines_for_stream(
     lines: Dict[str, Line],
     window: int = 10,
     min_score: float = 0.20,
+    line_rank: Optional[Dict[str, int]] = None,
 ) -> List[SegmentSpan]:
     spans: List[SegmentSpan] = []
     if not stream.seg_refs or not line_ids:
         return spans
 
-    ordered = sorted(set(line_ids), key=lambda lid: lines[lid].order_hint)
+    ordered = _sort_line_ids(set(line_ids), lines, line_rank)
     line_texts = [normalize_hebrew(lines[lid].vlm_text or "") for lid in ordered]
+    line_tokens = [set(t.split()) for t in line_texts]
     seg_texts = [normalize_hebrew(t) for t in stream.seg_texts]
 
     p = 0
@@ -140,14 +258,18 @@ def align_segments_to_lines_for_stream(
         if p >= len(ordered):
             break
 
-        best_q, best_sc = None, -1.0
+        # token_set_ratio only sees token sets, so the running union of line tokens
+        # scores the same as the concatenation of lines [p, q]
+        running: set = set()
+        candidates: List[str] = []
         for q in range(p, min(len(ordered), p + window)):
-            concat = " ".join(line_texts[p:q+1]).strip()
-            sc = score_text(concat, seg_text)
-            if sc > best_sc:
-                best_sc, best_q = sc, q
+            running |= line_tokens[q]
+            candidates.append(" ".join(sorted(running)))
+        scores = process.cdist([seg_text], candidates, scorer=token_set_ratio, dtype=np.float64)[0] / 100.0
+        k = int(scores.argmax())
+        best_q, best_sc = p + k, float(scores[k])
 
-        if best_q is None or best_sc < min_score:
+        if best_sc < min_score:
             spans.append(SegmentSpan(
                 stream_id=stream.stream_id,
                 seg_ref=seg_ref,
@@ -177,17 +299,23 @@ def align_segments_to_lines_for_stream(
 def extract_commentary_spans_from_blocks(
     blocks: Dict[str, Block],
     lines: Dict[str, Line],
+    line_rank: Optional[Dict[str, int]] = None,
+    rashi_block_ids: Optional[List[str]] = None,
 ) -> List[Tuple[str, str, str]]:
     """
     From each Rashi block, extract spans: first span = first line to first is_span_end (inclusive),
     next = from next line to next is_span_end, etc.; last span ends with last line of block.
     Returns list of (start_line_id, end_line_id, span_text).
+    rashi_block_ids: precomputed Rashi block ids (else blocks are filtered by font).
     """
+    if rashi_block_ids is None:
+        rashi_blocks = [b for b in blocks.values() if b.font == "rashi"]
+    else:
+        rashi_blocks = [blocks[bid] for bid in rashi_block_ids if bid in blocks]
+
     out: List[Tuple[str, str, str]] = []
-    for block in blocks.values():
-        if block.font != "rashi":
-            continue
-        ordered = sorted(block.line_ids, key=lambda lid: lines[lid].order_hint)
+    for block in rashi_blocks:
+        ordered = _sort_line_ids(block.line_ids, lines, line_rank)
         if not ordered:
             continue
         start = 0
@@ -207,51 +335,44 @@ def match_commentary_spans_to_streams(
     commentary_spans: List[Tuple[str, str, str]],
     streams: Dict[str, Stream],
     main_stream_id: str,
+    registry: Optional[EmbeddingRegistry] = None,
+    min_score: Optional[float] = None,
 ) -> List[SegmentSpan]:
     """
     For each (start_line_id, end_line_id, span_text), find best-matching commentary
-    segment (across all streams except main) via embeddings. Return list of SegmentSpan.
+    segment (across all streams except main) via embeddings. Return list of SegmentSpan;
+    if min_score is set, spans whose best cosine score is below it are left unmatched.
+    Pass a page-level registry (see register_commentary_embeddings) to share one embeddings call.
     """
-    from embeddings import get_embeddings, cosine_similarity
+    from embeddings import EmbeddingRegistry, l2_normalize
 
-    commentary_stream_ids = [sid for sid in streams.keys() if sid != main_stream_id]
-    if not commentary_stream_ids or not commentary_spans:
+    if not commentary_spans:
         return []
 
-    # All commentary segments: (stream_id, seg_ref, seg_text)
-    seg_triples: List[Tuple[str, str, str]] = []
-    for sid in commentary_stream_ids:
-        st = streams[sid]
-        for ref, text in zip(st.seg_refs, st.seg_texts):
-            seg_triples.append((sid, ref, (text or "").strip()))
-
+    seg_triples = _commentary_segments(streams, main_stream_id)
     if not seg_triples:
         return []
 
-    span_texts = [t for _, _, t in commentary_spans]
-    seg_texts = [t for _, _, t in seg_triples]
-    span_emb = get_embeddings(span_texts)
-    seg_emb = get_embeddings(seg_texts)
-
-    result: List[SegmentSpan] = []
-    for idx, (start_id, end_id, _) in enumerate(commentary_spans):
-        best_j = -1
-        best_sc = -1.0
-        for j in range(len(seg_triples)):
-            sc = cosine_similarity(span_emb[idx], seg_emb[j])
-            if sc > best_sc:
-                best_sc, best_j = sc, j
-        if best_j < 0:
-            continue
-        sid, seg_ref, _ = seg_triples[best_j]
-        result.append(
-            SegmentSpan(
-                stream_id=sid,
-                seg_ref=seg_ref,
-                start_line_id=start_id,
-                end_line_id=end_id,
-                score=best_sc,
-                flags=["commentary_embed"],
-            )
+    reg = registry if registry is not None else EmbeddingRegistry()
+    span_rows = reg.register_many([t for _, _, t in commentary_spans])
+    seg_rows = reg.register_many([t for _, _, t in seg_triples])
+    span_emb = l2_normalize(reg.vectors(span_rows))
+    seg_emb = l2_normalize(reg.vectors(seg_rows))
+
+    # Cosine similarity of every span against every segment: (M, K)
+    sim = span_emb @ seg_emb.T
+    best_j = sim.argmax(axis=1)
+    best_sc = sim[np.arange(len(best_j)), best_j]
+
+    return [
+        SegmentSpan(
+            stream_id=seg_triples[j][0],
+            seg_ref=seg_triples[j][1],
+            start_line_id=start_id,
+            end_line_id=end_id,
+            score=float(sc),
+            flags=["commentary_embed"],
         )
-    return result
+        for (start_id, end_id, _), j, sc in zip(commentary_spans, best_j.tolist(), best_sc.tolist())
+        if min_score is None or sc >= min_score
+    ]
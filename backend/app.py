@@ -1,16 +1,53 @@
 from __future__ import annotations
 
 import json
+import queue
+import threading
+from datetime import date
+import orjson
 from flask import Flask, request, jsonify, Response, stream_with_context
 from bson import ObjectId
+from werkzeug.http import http_date
 
-from graph import build_graph, serialize_state
+from graph import build_graph, save_session, page_png_base64
 from db import sessions, pages
 from page_schema import session_doc_to_tzuratlink_page
 
 app = Flask(__name__)
 graph_app = build_graph()
 
+# Session fields read by apply_fixes / finalize (session_doc_to_tzuratlink_page)
+FIX_FIELDS = {"blocks": 1, "segment_spans": 1}
+FINALIZE_FIELDS = {
+    "pdf_url": 1,
+    "source_pdf": 1,
+    "base_ref_range": 1,
+    "base64_data": 1,
+    "page_png_gridfs_id": 1,
+    "page_image_w": 1,
+    "page_image_h": 1,
+    "lines": 1,
+    "sorted_line_ids": 1,
+    "segment_spans": 1,
+    "created_at": 1,
+}
+
+
+def _json_default(o):
+    # Dates stay RFC 822 (HTTP date) like jsonify, not orjson's ISO 8601
+    if isinstance(o, date):
+        return http_date(o)
+    return str(o)
+
+
+def _json_response(obj, status: int = 200) -> Response:
+    """orjson-encoded JSON response for large docs (ObjectId etc. fall back to str)."""
+    return Response(
+        orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME),
+        status=status,
+        mimetype="application/json",
+    )
+
 
 def _require_json():
     if not request.is_json:
@@ -41,13 +78,9 @@ def start_session():
         return jsonify({"error": str(e)}), 500
 
     sid = out["session_id"]
-    sessions().update_one(
-        {"_id": sid},
-        {"$set": serialize_state(out), "$setOnInsert": {"_id": sid}},
-        upsert=True,
-    )
+    save_session(out)
 
-    return jsonify({
+    return _json_response({
         "session_id": sid,
         "needs_human_review": bool(out.get("needs_human_review")),
         "validation_flags": out.get("validation_flags", []),
@@ -103,10 +136,44 @@ def start_session_stream():
         resp, code = err
         return resp, code
 
+    # Run the graph on a worker thread so a slow client never stalls the pipeline;
+    # the response generator just drains the queue.
+    # If the client disconnects, the generator sets `cancelled` and the worker stops
+    # instead of blocking forever on a full queue.
+    events: queue.Queue = queue.Queue(maxsize=64)
+    done = object()
+    cancelled = threading.Event()
+
+    def put(item) -> bool:
+        while not cancelled.is_set():
+            try:
+                events.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_graph():
+        try:
+            for event in graph_app.stream(state, stream_mode=["updates", "values"]):
+                if not put(event):
+                    return  # closing the stream generator stops the remaining stages
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threading.Thread(target=run_graph, daemon=True).start()
+
     def generate():
         try:
             last_state = None
-            for event in graph_app.stream(state, stream_mode=["updates", "values"]):
+            while True:
+                event = events.get()
+                if event is done:
+                    break
+                if isinstance(event, Exception):
+                    raise event
                 if isinstance(event, tuple) and len(event) == 2:
                     mode, chunk = event
                     if mode == "updates" and isinstance(chunk, dict) and chunk:
@@ -121,11 +188,7 @@ def start_session_stream():
             if last_state:
                 sid = last_state.get("session_id")
                 if sid:
-                    sessions().update_one(
-                        {"_id": sid},
-                        {"$set": serialize_state(last_state), "$setOnInsert": {"_id": sid}},
-                        upsert=True,
-                    )
+                    save_session(last_state)
                     yield _sse_message({
                         "session_id": sid,
                         "needs_human_review": bool(last_state.get("needs_human_review")),
@@ -137,6 +200,8 @@ def start_session_stream():
             yield _sse_message({"error": f"PDF not found: {e}", "status": "error"})
         except Exception as e:
             yield _sse_message({"error": str(e), "status": "error"})
+        finally:
+            cancelled.set()
 
     return Response(
         stream_with_context(generate()),
@@ -151,11 +216,12 @@ def get_session(sid: str):
     if not doc:
         return jsonify({"error": "not_found"}), 404
     doc["_id"] = str(doc["_id"])
-    return jsonify(doc)
+    doc["base64_data"] = page_png_base64(doc)
+    return _json_response(doc)
 
 @app.post("/api/sessions/<sid>/apply_fixes")
 def apply_fixes(sid: str):
-    doc = sessions().find_one({"_id": sid})
+    doc = sessions().find_one({"_id": sid}, FIX_FIELDS)
     if not doc:
         return jsonify({"error": "not_found"}), 404
 
@@ -163,33 +229,38 @@ def apply_fixes(sid: str):
     if err:
         return jsonify({"error": err[0]}), err[1]
 
+    # Only the touched sub-fields are written (dotted paths), not the whole doc
+    delta = {}
     ba = payload.get("block_assignments") or {}
     for bid, sid_new in ba.items():
         if "blocks" in doc and bid in doc["blocks"]:
-            doc["blocks"][bid]["assigned_stream_id"] = sid_new
+            delta[f"blocks.{bid}.assigned_stream_id"] = sid_new
 
     cut_over = payload.get("cut_overrides") or []
     for ov in cut_over:
-        for sp in doc.get("segment_spans", []):
+        for i, sp in enumerate(doc.get("segment_spans", [])):
             if sp["stream_id"] == ov["stream_id"] and sp["seg_ref"] == ov["seg_ref"]:
                 sp["end_cut_x"] = int(ov["end_cut_x"])
                 flags = sp.get("flags", [])
                 if "cut_ok" not in flags:
                     flags.append("cut_ok")
                 sp["flags"] = flags
+                delta[f"segment_spans.{i}.end_cut_x"] = sp["end_cut_x"]
+                delta[f"segment_spans.{i}.flags"] = flags
 
-    doc["needs_human_review"] = False
-    doc["validation_flags"] = []
+    delta["needs_human_review"] = False
+    delta["validation_flags"] = []
 
-    sessions().update_one({"_id": sid}, {"$set": doc}, upsert=True)
+    sessions().update_one({"_id": sid}, {"$set": delta})
     return jsonify({"ok": True})
 
 @app.post("/api/sessions/<sid>/finalize")
 def finalize(sid: str):
-    doc = sessions().find_one({"_id": sid})
+    doc = sessions().find_one({"_id": sid}, FINALIZE_FIELDS)
     if not doc:
         return jsonify({"error": "not_found"}), 404
 
+    doc["base64_data"] = page_png_base64(doc)
     page_doc = session_doc_to_tzuratlink_page(doc)
     res = pages().insert_one(page_doc)
 
@@ -203,7 +274,7 @@ def get_page(page_id: str):
         return jsonify({"error": "not_found"}), 404
     doc["_id"] = str(doc["_id"])
     doc["id"] = doc["_id"]  # tzuratlink-data compatibility
-    return jsonify(doc)
+    return _json_response(doc)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
@@ -10,7 +10,10 @@ load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB = os.getenv("MONGO_DB", "tagger")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
 SEFARIA_BASE = os.getenv("SEFARIA_BASE", "https://www.sefaria.org")
+# How long fetched Sefaria texts stay in the Mongo cache
+SEFARIA_CACHE_TTL_DAYS = int(os.getenv("SEFARIA_CACHE_TTL_DAYS", "7"))
 
 # OpenAI Vision (line OCR)
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
@@ -18,15 +21,26 @@ OPENAI_MODEL = (os.getenv("OPENAI_MODEL") or "gpt-4o-mini").strip()
 OPENAI_TIMEOUT_S = int(os.getenv("OPENAI_TIMEOUT_S", "60"))
 OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
 VLM_BATCH_SIZE = int(os.getenv("VLM_BATCH_SIZE", "12"))
+# Max VLM requests in flight at once
+VLM_CONCURRENCY = max(1, int(os.getenv("VLM_CONCURRENCY", "8")))
 
 # OpenAI Embeddings (for commentary and main-text alignment)
 OPENAI_EMBEDDING_MODEL = (os.getenv("OPENAI_EMBEDDING_MODEL") or "text-embedding-3-small").strip()
+# Reduced output size for text-embedding-3-* (API "dimensions"); 0 = model default
+OPENAI_EMBEDDING_DIMENSIONS = int(os.getenv("OPENAI_EMBEDDING_DIMENSIONS", "512"))
 OPENAI_EMBEDDING_BATCH_SIZE = int(os.getenv("OPENAI_EMBEDDING_BATCH_SIZE", "100"))
+# Max embedding batches in flight at once (bounded to stay clear of rate limits)
+OPENAI_EMBEDDING_CONCURRENCY = max(1, int(os.getenv("OPENAI_EMBEDDING_CONCURRENCY", "8")))
 # Use embeddings for main-text segment alignment (else fuzzy text match)
 USE_EMBEDDINGS_FOR_MAIN_ALIGN = os.getenv("USE_EMBEDDINGS_FOR_MAIN_ALIGN", "").strip().lower() in ("1", "true", "yes")
 
 # Rashi Tesseract (tessdata dir containing rashi.tessdata; e.g. /data in Docker)
 RASHI_TESSDATA_DIR = (os.getenv("RASHI_TESSDATA_DIR") or "data").strip()
+# Tessdata dir for the default (non-Rashi) languages when OCR runs in-process via tesserocr,
+# whose wheels otherwise look in their own build prefix (default: Debian's tesseract-ocr path)
+TESSDATA_DIR = (os.getenv("TESSDATA_PREFIX") or "/usr/share/tesseract-ocr/5/tessdata").strip()
+# Concurrent tesseract subprocesses for per-crop OCR
+TESSERACT_WORKERS = max(1, int(os.getenv("TESSERACT_WORKERS", str(os.cpu_count() or 1))))
 
 # Commentary filter: only include Sefaria commentary whose title starts with one of these.
 # Load from commentary_config.json (gitignored); copy from commentary_config.example.json.
@@ -1,14 +1,16 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict
+import numpy as np
 import pytesseract
 from PIL import Image
+from rapidfuzz import process
 from rapidfuzz.fuzz import ratio
 
 from models import SegmentSpan, Stream, Line, BBox
-
-def normalize_hebrew(text: str) -> str:
-    return " ".join((text or "").strip().split())
+from text_norm import normalize_hebrew
+from config import TESSERACT_WORKERS
 
 def last_word(seg_text: str) -> str:
     t = normalize_hebrew(seg_text)
@@ -18,10 +20,8 @@ def last_word(seg_text: str) -> str:
 def tesseract_word_boxes_for_crop(img: Image.Image) -> List[Tuple[str, BBox]]:
     data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
     out: List[Tuple[str, BBox]] = []
-    n = len(data["level"])
-    for i in range(n):
-        if data["level"][i] != 5:
-            continue
+    # Word rows only (level 5)
+    for i in np.flatnonzero(np.asarray(data["level"]) == 5):
         txt = (data["text"][i] or "").strip()
         if not txt:
             continue
@@ -33,6 +33,19 @@ def tesseract_word_boxes_for_crop(img: Image.Image) -> List[Tuple[str, BBox]]:
         )))
     return out
 
+def _best_word_match(crop: Image.Image, lw_n: str, word_match_thresh: float) -> BBox | None:
+    """OCR the crop and return the word box best matching the normalized last word, if any clears the threshold."""
+    word_boxes = tesseract_word_boxes_for_crop(crop)
+    hit = process.extractOne(
+        lw_n,
+        [normalize_hebrew(wt) for wt, _ in word_boxes],
+        scorer=ratio,
+        score_cutoff=word_match_thresh,
+    )
+    if hit is None:
+        return None
+    return word_boxes[hit[2]][1]
+
 def compute_boundary_cuts_for_spans(
     page_img: Image.Image,
     spans: List[SegmentSpan],
@@ -40,33 +53,36 @@ def compute_boundary_cuts_for_spans(
     lines: Dict[str, Line],
     word_match_thresh: float = 60.0,
 ) -> List[Tuple[str, str]]:
-    failures: List[Tuple[str, str]] = []
+    # Per span: failure flag, or (crop x0, crop, normalized last word) for OCR
+    prepared: List[str | Tuple[int, Image.Image, str]] = []
+    # First index of each seg_ref per stream (matches list.index)
+    seg_ref_idx: Dict[str, Dict[str, int]] = {}
+    for sid, st in streams.items():
+        ref_idx: Dict[str, int] = {}
+        for i, ref in enumerate(st.seg_refs):
+            ref_idx.setdefault(ref, i)
+        seg_ref_idx[sid] = ref_idx
 
     for sp in spans:
         st = streams.get(sp.stream_id)
         if not st:
-            sp.flags.append("missing_stream")
-            failures.append((sp.stream_id, sp.seg_ref))
+            prepared.append("missing_stream")
             continue
 
-        try:
-            idx = st.seg_refs.index(sp.seg_ref)
-            seg_text = st.seg_texts[idx]
-        except ValueError:
-            sp.flags.append("missing_seg_ref")
-            failures.append((sp.stream_id, sp.seg_ref))
+        idx = seg_ref_idx[sp.stream_id].get(sp.seg_ref)
+        if idx is None:
+            prepared.append("missing_seg_ref")
             continue
+        seg_text = st.seg_texts[idx]
 
         lw = last_word(seg_text)
         if not lw:
-            sp.flags.append("no_last_word")
-            failures.append((sp.stream_id, sp.seg_ref))
+            prepared.append("no_last_word")
             continue
 
         end_line = lines.get(sp.end_line_id)
         if not end_line:
-            sp.flags.append("missing_end_line")
-            failures.append((sp.stream_id, sp.seg_ref))
+            prepared.append("missing_end_line")
             continue
 
         pad = 6
@@ -75,25 +91,35 @@ def compute_boundary_cuts_for_spans(
         x1 = min(page_img.width, end_line.bbox.x + end_line.bbox.w + pad)
         y1 = min(page_img.height, end_line.bbox.y + end_line.bbox.h + pad)
         crop = page_img.crop((x0, y0, x1, y1))
+        prepared.append((x0, crop, normalize_hebrew(lw)))
+
+    # Each OCR call is a tesseract subprocess, so threads run them in parallel
+    jobs = [i for i, p in enumerate(prepared) if not isinstance(p, str)]
+    matches: Dict[int, BBox | None] = {}
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(TESSERACT_WORKERS, len(jobs))) as ex:
+            results = ex.map(
+                _best_word_match,
+                [prepared[i][1] for i in jobs],
+                [prepared[i][2] for i in jobs],
+                [word_match_thresh] * len(jobs),
+            )
+            matches = dict(zip(jobs, results))
 
-        word_boxes = tesseract_word_boxes_for_crop(crop)
-
-        best_bbox = None
-        best_sc = -1.0
-        lw_n = normalize_hebrew(lw)
-
-        for wt, wb in word_boxes:
-            sc = ratio(normalize_hebrew(wt), lw_n)
-            if sc > best_sc:
-                best_sc = sc
-                best_bbox = wb
+    failures: List[Tuple[str, str]] = []
+    for i, (sp, prep) in enumerate(zip(spans, prepared)):
+        if isinstance(prep, str):
+            sp.flags.append(prep)
+            failures.append((sp.stream_id, sp.seg_ref))
+            continue
 
-        if best_bbox is None or best_sc < word_match_thresh:
+        best_bbox = matches[i]
+        if best_bbox is None:
             sp.flags.append("cut_failed")
             failures.append((sp.stream_id, sp.seg_ref))
             continue
 
-        sp.end_cut_x = x0 + best_bbox.x
+        sp.end_cut_x = prep[0] + best_bbox.x
         sp.flags.append("cut_ok")
 
     return failures
@@ -1,7 +1,14 @@
+import gridfs
 from pymongo import MongoClient
-from config import MONGO_URI, MONGO_DB
+from config import MONGO_URI, MONGO_DB, MONGO_MAX_POOL_SIZE
 
-_client = MongoClient(MONGO_URI)
+# Session docs are large (lines, spans, page image); compress on the wire
+_client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    compressors="zstd,zlib",
+    appname="tzuratlink-data-llm",
+)
 _db = _client[MONGO_DB]
 
 def sessions():
@@ -9,3 +16,16 @@ def sessions():
 
 def pages():
     return _db["pages"]
+
+def embedding_cache():
+    return _db["embedding_cache"]
+
+def sefaria_cache():
+    return _db["sefaria_cache"]
+
+def font_cache():
+    return _db["font_cache"]
+
+def page_images():
+    """GridFS bucket for rendered page PNGs (kept out of session docs)."""
+    return gridfs.GridFSBucket(_db, bucket_name="page_images")
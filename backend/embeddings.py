@@ -1,10 +1,36 @@
 from __future__ import annotations
 
+import hashlib
 import math
-from typing import List
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
+import numpy as np
+from bson.binary import Binary
 from openai import OpenAI
-from config import OPENAI_API_KEY, OPENAI_EMBEDDING_MODEL, OPENAI_EMBEDDING_BATCH_SIZE
+from pymongo.errors import PyMongoError
+from rapidfuzz.fuzz import ratio
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_EMBEDDING_MODEL,
+    OPENAI_EMBEDDING_DIMENSIONS,
+    OPENAI_EMBEDDING_BATCH_SIZE,
+    OPENAI_EMBEDDING_CONCURRENCY,
+    OPENAI_TIMEOUT_S,
+    OPENAI_MAX_RETRIES,
+)
+from db import embedding_cache
+from text_norm import normalize_hebrew
+
+# One client (and httpx connection pool) for the process, reused across calls
+_CLIENT = (
+    OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_S, max_retries=OPENAI_MAX_RETRIES)
+    if OPENAI_API_KEY
+    else None
+)
 
 
 def _safe_to_text(x) -> str:
@@ -19,55 +45,338 @@ def _safe_to_text(x) -> str:
         return ""
 
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Return embedding vectors for each text. Batches requests."""
+# Keep stable alignment with inputs
+# We'll replace invalid/empty items with a small placeholder so counts match.
+PLACEHOLDER = " "  # safer than "" for many embedding models
+
+# Very rough char cap to avoid token-limit explosions (tune as needed)
+# Hebrew tends to be tokenized reasonably; 12k chars is a safe default for most embedding models.
+MAX_CHARS = 12000
+
+
+def _prepare_text(x) -> str:
+    s = _safe_to_text(x).strip()
+    if not s:
+        s = PLACEHOLDER
+    if len(s) > MAX_CHARS:
+        s = s[:MAX_CHARS]
+    return s
+
+
+def _model_tag() -> str:
+    """Cache namespace: model plus requested dimensions, so vectors of different sizes never mix."""
+    if OPENAI_EMBEDDING_DIMENSIONS > 0:
+        return f"{OPENAI_EMBEDDING_MODEL}@{OPENAI_EMBEDDING_DIMENSIONS}"
+    return OPENAI_EMBEDDING_MODEL
+
+
+def _cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+# Near-duplicate reuse: OCR output for the same line often differs by a character or two,
+# so misses are retried by canonical text (normalize_hebrew) and then by MinHash LSH over
+# 3-char shingles, accepting a cached vector whose canonical text is >= 95% similar.
+NEAR_DUP_MIN_RATIO = 95.0
+NEAR_DUP_MIN_CHARS = 20  # shorter texts are too noisy for shingles; exact/canonical only
+NEAR_DUP_MAX_CANDIDATES = 2000  # per lookup; bounds the fetch and the ratio scan on a big cache
+_SHINGLE = 3
+_MINHASH_PERMS = 64
+_LSH_BANDS = 16
+_MH_PRIME = (1 << 31) - 1
+_mh_rng = np.random.default_rng(0x7A17)
+_MH_A = _mh_rng.integers(1, _MH_PRIME, size=_MINHASH_PERMS, dtype=np.uint64)
+_MH_B = _mh_rng.integers(0, _MH_PRIME, size=_MINHASH_PERMS, dtype=np.uint64)
+
+_cache_indexes_ready = False
+
+
+def _lsh_bands(model: str, canon: str) -> List[str]:
+    """MinHash signature of the canonical text, hashed per band (band index + model scoped)."""
+    shingles = {canon[i : i + _SHINGLE] for i in range(len(canon) - _SHINGLE + 1)}
+    x = np.fromiter(
+        (zlib.crc32(sh.encode("utf-8")) & _MH_PRIME for sh in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    sig = ((np.outer(x, _MH_A) + _MH_B) % _MH_PRIME).min(axis=0)
+    rows = _MINHASH_PERMS // _LSH_BANDS
+    prefix = model.encode("utf-8") + b"\x00"
+    return [
+        f"{i}:{hashlib.blake2b(prefix + sig[i * rows : (i + 1) * rows].tobytes(), digest_size=8).hexdigest()}"
+        for i in range(_LSH_BANDS)
+    ]
+
+
+def _ensure_cache_indexes() -> None:
+    global _cache_indexes_ready
+    if _cache_indexes_ready:
+        return
+    try:
+        embedding_cache().create_index("c")
+        embedding_cache().create_index("b")
+        _cache_indexes_ready = True
+    except PyMongoError:
+        pass
+
+
+def _pack(vec) -> Binary:
+    """Vector -> float16 bytes for the cache (4x smaller than a BSON array of doubles)."""
+    return Binary(np.asarray(vec, dtype=np.float16).tobytes())
+
+
+def _unpack(v) -> np.ndarray:
+    """Cached "v" -> float32 vector; also reads entries written as plain float lists."""
+    if isinstance(v, (bytes, bytearray)):
+        return np.frombuffer(v, dtype=np.float16).astype(np.float32)
+    return np.asarray(v, dtype=np.float32)
+
+
+# Process-wide LRU in front of the Mongo cache, so HITL re-runs and overlapping pages
+# in the same process skip the round-trip (512-dim float32 ~2 KB per entry)
+_MEM_CACHE_MAX = 16384
+_mem_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_mem_lock = threading.Lock()
+
+
+def _mem_get(keys: List[str]) -> Dict[str, np.ndarray]:
+    out: Dict[str, np.ndarray] = {}
+    with _mem_lock:
+        for k in keys:
+            v = _mem_cache.get(k)
+            if v is not None:
+                _mem_cache.move_to_end(k)
+                out[k] = v
+    return out
+
+
+def _mem_put(vectors: Dict[str, np.ndarray]) -> None:
+    with _mem_lock:
+        for k, v in vectors.items():
+            _mem_cache[k] = v
+            _mem_cache.move_to_end(k)
+        while len(_mem_cache) > _MEM_CACHE_MAX:
+            _mem_cache.popitem(last=False)
+
+
+def _cache_lookup(keys: List[str]) -> Dict[str, np.ndarray]:
+    """Cached vectors by key; a cache outage just means everything is a miss."""
+    if not keys:
+        return {}
+    try:
+        return {d["_id"]: _unpack(d["v"]) for d in embedding_cache().find({"_id": {"$in": keys}})}
+    except PyMongoError:
+        return {}
+
+
+def _cache_lookup_near(canon: Dict[str, str]) -> Dict[str, np.ndarray]:
+    """
+    canon: {exact_key: canonical_text} for exact-key misses.
+    Returns {exact_key: vector} for misses served by a canonical-text or near-duplicate hit.
+    """
+    model = _model_tag()
+    out: Dict[str, np.ndarray] = {}
+    try:
+        coll = embedding_cache()
+        ckeys = {k: _cache_key(model, c) for k, c in canon.items()}
+        by_c = {
+            d["c"]: _unpack(d["v"])
+            for d in coll.find({"c": {"$in": list(set(ckeys.values()))}}, {"c": 1, "v": 1})
+        }
+        for k, ck in ckeys.items():
+            if ck in by_c:
+                out[k] = by_c[ck]
+
+        bands = {
+            k: set(_lsh_bands(model, c))
+            for k, c in canon.items()
+            if k not in out and len(c) >= NEAR_DUP_MIN_CHARS
+        }
+        if not bands:
+            return out
+        all_bands = list(set().union(*bands.values()))
+        # Candidates indexed by the wanted bands they share, so each miss only scans its own
+        by_band: Dict[str, List[dict]] = {}
+        for d in coll.find({"b": {"$in": all_bands}}, {"t": 1, "b": 1}).limit(
+            NEAR_DUP_MAX_CANDIDATES
+        ):
+            for b in d.get("b") or ():
+                by_band.setdefault(b, []).append(d)
+
+        matched_id: Dict[str, str] = {}
+        for k, kb in bands.items():
+            seen: set = set()
+            for b in kb:
+                for d in by_band.get(b, ()):
+                    if d["_id"] in seen:
+                        continue
+                    seen.add(d["_id"])
+                    if ratio(canon[k], d.get("t") or "", score_cutoff=NEAR_DUP_MIN_RATIO):
+                        matched_id[k] = d["_id"]  # first match >= threshold is good enough
+                        break
+                if k in matched_id:
+                    break
+        if matched_id:
+            vecs = {
+                d["_id"]: _unpack(d["v"])
+                for d in coll.find({"_id": {"$in": list(set(matched_id.values()))}}, {"v": 1})
+            }
+            for k, did in matched_id.items():
+                if did in vecs:
+                    out[k] = vecs[did]
+    except PyMongoError:
+        pass
+    return out
+
+
+def _cache_store(entries: Dict[str, Tuple[np.ndarray, str]]) -> None:
+    """entries: {exact_key: (vector, canonical_text)}."""
+    if not entries:
+        return
+    model = _model_tag()
+    docs = []
+    for k, (v, canon) in entries.items():
+        doc = {"_id": k, "v": _pack(v), "c": _cache_key(model, canon), "t": canon}
+        if len(canon) >= NEAR_DUP_MIN_CHARS:
+            doc["b"] = _lsh_bands(model, canon)
+        docs.append(doc)
+    try:
+        embedding_cache().insert_many(docs, ordered=False)
+    except PyMongoError:
+        # Duplicate keys from a concurrent writer (or cache outage) are harmless
+        pass
+
+
+def _embed_batch(batch_keys: List[str], missing: Dict[str, Tuple[str, object]]) -> Dict[str, np.ndarray]:
+    """Embed one API batch; returns {key: vector}."""
+    batch = [missing[k][0] for k in batch_keys]
+    try:
+        if OPENAI_EMBEDDING_DIMENSIONS > 0:
+            resp = _CLIENT.embeddings.create(
+                model=OPENAI_EMBEDDING_MODEL, input=batch, dimensions=OPENAI_EMBEDDING_DIMENSIONS
+            )
+        else:
+            resp = _CLIENT.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=batch)
+    except Exception as e:
+        # Add a high-signal error message for debugging the exact offender
+        lens = [(j, len(batch[j]), type(missing[k][1]).__name__) for j, k in enumerate(batch_keys)]
+        raise RuntimeError(
+            f"Embeddings request failed: {e}. "
+            f"Model={OPENAI_EMBEDDING_MODEL!r} dimensions={OPENAI_EMBEDDING_DIMENSIONS or 'default'}. "
+            f"Batch diagnostics (idx,len,type)={lens[:10]}{'...' if len(lens)>10 else ''}"
+        ) from e
+
+    # The API returns embeddings aligned to inputs
+    return {k: np.asarray(d.embedding, dtype=np.float32) for k, d in zip(batch_keys, resp.data)}
+
+
+def get_embeddings(texts: List[str]) -> List[np.ndarray]:
+    """
+    Return float32 embedding vectors for each text. Vectors are cached (process LRU, then
+    Mongo) keyed by sha256(model, text), with a canonical-text / near-duplicate fallback; only true
+    cache misses are sent to OpenAI, in batches.
+    """
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY required for embeddings.")
     if not isinstance(OPENAI_EMBEDDING_MODEL, str) or not OPENAI_EMBEDDING_MODEL.strip():
         raise RuntimeError(f"OPENAI_EMBEDDING_MODEL is empty/invalid: {OPENAI_EMBEDDING_MODEL!r}")
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    out: List[List[float]] = []
-
-    # Keep stable alignment with inputs
-    # We'll replace invalid/empty items with a small placeholder so counts match.
-    PLACEHOLDER = " "  # safer than "" for many embedding models
-
-    # Very rough char cap to avoid token-limit explosions (tune as needed)
-    # Hebrew tends to be tokenized reasonably; 12k chars is a safe default for most embedding models.
-    MAX_CHARS = 12000
-
-    for i in range(0, len(texts), OPENAI_EMBEDDING_BATCH_SIZE):
-        raw_batch = texts[i : i + OPENAI_EMBEDDING_BATCH_SIZE]
-
-        batch: List[str] = []
-        for t in raw_batch:
-            s = _safe_to_text(t).strip()
-            if not s:
-                s = PLACEHOLDER
-            if len(s) > MAX_CHARS:
-                s = s[:MAX_CHARS]
-            batch.append(s)
-
-        try:
-            resp = client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=batch)
-        except Exception as e:
-            # Add a high-signal error message for debugging the exact offender
-            lens = [(j, len(batch[j]), type(raw_batch[j]).__name__) for j in range(len(batch))]
-            raise RuntimeError(
-                f"Embeddings request failed: {e}. "
-                f"Model={OPENAI_EMBEDDING_MODEL!r}. "
-                f"Batch diagnostics (idx,len,type)={lens[:10]}{'...' if len(lens)>10 else ''}"
-            ) from e
-
-        # The API returns embeddings aligned to inputs
-        for d in resp.data:
-            out.append(d.embedding)
+    _ensure_cache_indexes()
+    prepared = [_prepare_text(t) for t in texts]
+    tag = _model_tag()
+    keys = [_cache_key(tag, s) for s in prepared]
+    uniq = list(set(keys))
+    vectors = _mem_get(uniq)
+    if len(vectors) < len(uniq):
+        from_db = _cache_lookup([k for k in uniq if k not in vectors])
+        _mem_put(from_db)
+        vectors.update(from_db)
 
-    return out
+    # Unique misses (key -> (text, raw input)), in input order
+    missing: Dict[str, Tuple[str, object]] = {}
+    for k, s, raw in zip(keys, prepared, texts):
+        if k not in vectors and k not in missing:
+            missing[k] = (s, raw)
+
+    if missing:
+        canon = {k: normalize_hebrew(s) for k, (s, _) in missing.items()}
+        reused = _cache_lookup_near(canon)
+        # Alias near-duplicate hits under their exact key so the next run hits directly
+        _cache_store({k: (v, canon[k]) for k, v in reused.items()})
+        _mem_put(reused)
+        vectors.update(reused)
+        for k in reused:
+            del missing[k]
+
+    if missing:
+        miss_keys = list(missing.keys())
+        batches = [
+            miss_keys[i : i + OPENAI_EMBEDDING_BATCH_SIZE]
+            for i in range(0, len(miss_keys), OPENAI_EMBEDDING_BATCH_SIZE)
+        ]
+        fetched: Dict[str, np.ndarray] = {}
+        workers = min(OPENAI_EMBEDDING_CONCURRENCY, len(batches))
+        if workers <= 1:
+            for batch_keys in batches:
+                fetched.update(_embed_batch(batch_keys, missing))
+        else:
+            # Batches are independent; overlap their round-trips on the shared client
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                for part in ex.map(lambda bk: _embed_batch(bk, missing), batches):
+                    fetched.update(part)
+
+        _cache_store({k: (v, canon[k]) for k, v in fetched.items()})
+        _mem_put(fetched)
+        vectors.update(fetched)
+
+    return [vectors[k] for k in keys]
+
+
+def l2_normalize(vecs) -> np.ndarray:
+    """Row-wise unit vectors (float32), so cosine similarity is a plain dot product."""
+    a = np.array(vecs, dtype=np.float32)
+    a /= np.linalg.norm(a, axis=-1, keepdims=True) + 1e-12
+    return a
+
+
+class EmbeddingRegistry:
+    """
+    Page-level embedding batch: callers register texts (deduplicated) and get back row
+    indices; flush() embeds every pending text with a single get_embeddings call.
+    """
+
+    def __init__(self) -> None:
+        self._index: Dict[str, int] = {}
+        self._texts: List[str] = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def register(self, text: str) -> int:
+        idx = self._index.get(text)
+        if idx is None:
+            idx = len(self._texts)
+            self._index[text] = idx
+            self._texts.append(text)
+        return idx
+
+    def register_many(self, texts: List[str]) -> List[int]:
+        return [self.register(t) for t in texts]
+
+    def flush(self) -> None:
+        """Embed texts registered since the last flush (no-op if none)."""
+        done = self._vectors.shape[0]
+        if done == len(self._texts):
+            return
+        new = np.asarray(get_embeddings(self._texts[done:]), dtype=np.float32)
+        self._vectors = new if done == 0 else np.concatenate([self._vectors, new])
+
+    def vectors(self, idxs: List[int]) -> np.ndarray:
+        """(len(idxs), D) float32 rows; flushes pending texts first."""
+        self.flush()
+        return self._vectors[idxs]
 
 
 def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """Legacy scalar cosine; hot paths use l2_normalize + matmul instead."""
     if not a or not b or len(a) != len(b):
         return 0.0
     dot = sum(x * y for x, y in zip(a, b))
@@ -2,12 +2,24 @@ from __future__ import annotations
 
 import base64
 import os
-from typing import Dict, List
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
 from pdf2image import convert_from_path
 import uuid
 
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # fall back to pdf2image/pdftoppm
+    fitz = None
+
 from langgraph.graph import StateGraph, END  # type: ignore[import-untyped]
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from pymongo.errors import PyMongoError
+from pymongo.write_concern import WriteConcern
 
 from models import PipelineState, Stream, SegmentSpan
 from tess_layout import extract_blocks_lines, filter_margin_blocks
@@ -20,15 +32,32 @@ from align import (
     align_segments_to_lines_for_stream_embeddings,
     extract_commentary_spans_from_blocks,
     match_commentary_spans_to_streams,
+    register_stream_embeddings,
+    register_commentary_embeddings,
+    line_order_rank,
+    sorted_line_ids,
 )
+from embeddings import EmbeddingRegistry
 from cuts import compute_boundary_cuts_for_spans
 from validate import validate_state
-from db import sessions, pages
+from db import sessions, pages, page_images
 from config import RASHI_TESSDATA_DIR, USE_EMBEDDINGS_FOR_MAIN_ALIGN
 from pdf_utils import ensure_local_pdf
 from page_schema import session_doc_to_tzuratlink_page
 
 
+RENDER_DPI = 350
+
+# fitz.Document is not thread-safe; renders from concurrent sessions take turns
+_PDF_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _open_pdf(path: str, mtime: float):
+    """Open documents are reused across pages of the same PDF (mtime: re-open if replaced)."""
+    return fitz.open(path)
+
+
 def node_render_page(state: PipelineState) -> PipelineState:
     pdf_url = state["pdf_url"]
     page_index = int(state["page_index"])
@@ -37,20 +66,60 @@ def node_render_page(state: PipelineState) -> PipelineState:
     state["session_id"] = session_id
 
     local_pdf = ensure_local_pdf(pdf_url, session_id)
-
-    images = convert_from_path(local_pdf, dpi=350, first_page=page_index+1, last_page=page_index+1)
-    img = images[0]
     out_path = f"/tmp/{session_id}_p{page_index}.png"
-    img.save(out_path, "PNG")
+
+    if fitz is not None:
+        # In-process rasterization: no pdftoppm fork or PPM round-trip
+        with _PDF_LOCK:
+            page = _open_pdf(local_pdf, os.path.getmtime(local_pdf)).load_page(page_index)
+            pix = page.get_pixmap(matrix=fitz.Matrix(RENDER_DPI / 72, RENDER_DPI / 72), alpha=False)
+        pix.save(out_path)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    else:
+        # pdftoppm writes the PNG itself (no PPM pipe + re-encode); thread_count only
+        # matters when a range of pages is requested
+        paths = convert_from_path(
+            local_pdf,
+            dpi=RENDER_DPI,
+            first_page=page_index+1,
+            last_page=page_index+1,
+            thread_count=os.cpu_count() or 1,
+            output_folder=os.path.dirname(out_path),
+            output_file=os.path.splitext(os.path.basename(out_path))[0],
+            single_file=True,
+            fmt="png",
+            paths_only=True,
+        )
+        with Image.open(paths[0]) as im:
+            img = im.convert("RGB")
 
     state["page_png_path"] = out_path
+    state["page_img"] = img
     state["page_image_w"] = img.width
     state["page_image_h"] = img.height
     return state
 
 
+def _page_img(state: PipelineState) -> Image.Image:
+    """Decoded page from render_page; re-read from the PNG only if it is not in state."""
+    img = state.get("page_img")
+    if img is None:
+        img = Image.open(state["page_png_path"]).convert("RGB")
+        state["page_img"] = img
+    return img
+
+
+def _page_gray(state: PipelineState) -> Image.Image:
+    """Single-channel page for OCR: Tesseract binarizes anyway, and crops are 3x smaller."""
+    gray = state.get("page_gray")
+    if gray is None:
+        gray = _page_img(state).convert("L")
+        state["page_gray"] = gray
+    return gray
+
+
 def node_extract_blocks_lines(state: PipelineState) -> PipelineState:
-    blocks, lines = extract_blocks_lines(state["page_png_path"])
+    blocks, lines = extract_blocks_lines(_page_gray(state))
     state["blocks"] = blocks
     state["lines"] = lines
     return state
@@ -65,7 +134,7 @@ def node_filter_margin_blocks(state: PipelineState) -> PipelineState:
 
 
 def node_classify_block_font(state: PipelineState) -> PipelineState:
-    img = Image.open(state["page_png_path"]).convert("RGB")
+    img = _page_img(state)
     blocks = state["blocks"]
     items = []
     for bid, blk in blocks.items():
@@ -76,30 +145,42 @@ def node_classify_block_font(state: PipelineState) -> PipelineState:
         y1 = min(img.height, blk.bbox.y + blk.bbox.h + pad)
         crop = img.crop((x0, y0, x1, y1))
         items.append((bid, crop))
-    if not items:
-        return state
-    result = vlm_classify_block_font(items)
-    for bid, font in result.items():
-        if bid in blocks:
-            blocks[bid].font = font
+    if items:
+        result = vlm_classify_block_font(items)
+        for bid, font in result.items():
+            if bid in blocks:
+                blocks[bid].font = font
+    # Fonts are final from here on; later nodes take these instead of re-scanning blocks
+    state["rashi_block_ids"] = [bid for bid, b in blocks.items() if b.font == "rashi"]
+    state["hebrew_block_ids"] = [bid for bid, b in blocks.items() if b.font != "rashi"]
     return state
 
 
 def node_split_rashi_lines(state: PipelineState) -> PipelineState:
-    img = Image.open(state["page_png_path"]).convert("RGB")
-    split_rashi_lines(img, state["blocks"], state["lines"])
+    img = _page_gray(state)
+    split_rashi_lines(
+        img, state["blocks"], state["lines"], state.get("rashi_block_ids"), RASHI_TESSDATA_DIR
+    )
+    # Lines are final after the split; later nodes and page export reuse this order
+    state["sorted_line_ids"] = sorted_line_ids(state["lines"])
     return state
 
 
+def _line_rank(state: PipelineState) -> Dict[str, int]:
+    return line_order_rank(state["lines"], state.get("sorted_line_ids"))
+
+
 def node_rashi_tesseract(state: PipelineState) -> PipelineState:
-    img = Image.open(state["page_png_path"]).convert("RGB")
-    run_rashi_tesseract(img, state["blocks"], state["lines"], RASHI_TESSDATA_DIR)
+    img = _page_gray(state)
+    run_rashi_tesseract(
+        img, state["blocks"], state["lines"], RASHI_TESSDATA_DIR, state.get("rashi_block_ids")
+    )
     return state
 
 
 def node_fill_line_text(state: PipelineState) -> PipelineState:
     """Fill line text from Tesseract only (Rashi lines: rashi_tess_text; Hebrew: default Tesseract). No VLM."""
-    img = Image.open(state["page_png_path"]).convert("RGB")
+    img = _page_gray(state)
     fill_line_text_from_tesseract(img, state["blocks"], state["lines"])
     return state
 
@@ -122,6 +203,7 @@ def node_assign_blocks(state: PipelineState) -> PipelineState:
         blocks=state["blocks"],
         lines=state["lines"],
         streams=state["streams"],
+        line_rank=_line_rank(state),
     )
     state["unknown_block_ids"] = unknown
     state["unassigned_stream_ids"] = unassigned
@@ -135,39 +217,71 @@ def node_align_segments(state: PipelineState) -> PipelineState:
 
     spans: List[SegmentSpan] = []
     main_sid = next(iter(streams.keys()), "s0")
-    for sid, st in streams.items():
-        stream_line_ids = [
+    line_rank = _line_rank(state)
+    stream_line_ids: Dict[str, List[str]] = {
+        sid: [
             lid for blk in blocks.values()
             if blk.assigned_stream_id == sid
             for lid in blk.line_ids
         ]
-        if not stream_line_ids:
+        for sid in streams.keys()
+    }
+
+    # One embeddings request per page: queue main-text and commentary texts up front
+    registry = EmbeddingRegistry()
+    if USE_EMBEDDINGS_FOR_MAIN_ALIGN and main_sid in streams:
+        register_stream_embeddings(
+            registry, streams[main_sid], stream_line_ids[main_sid], lines, line_rank
+        )
+    commentary_spans = extract_commentary_spans_from_blocks(
+        blocks, lines, line_rank, state.get("rashi_block_ids")
+    )
+    register_commentary_embeddings(registry, commentary_spans, streams, main_sid)
+    registry.flush()
+    state["embedding_registry"] = registry
+    state["commentary_spans"] = commentary_spans
+
+    for sid, st in streams.items():
+        if not stream_line_ids[sid]:
             continue
         if USE_EMBEDDINGS_FOR_MAIN_ALIGN and sid == main_sid:
             spans.extend(
-                align_segments_to_lines_for_stream_embeddings(st, stream_line_ids, lines)
+                align_segments_to_lines_for_stream_embeddings(
+                    st, stream_line_ids[sid], lines, registry=registry, line_rank=line_rank
+                )
             )
         else:
-            spans.extend(align_segments_to_lines_for_stream(st, stream_line_ids, lines))
+            spans.extend(
+                align_segments_to_lines_for_stream(st, stream_line_ids[sid], lines, line_rank=line_rank)
+            )
 
     state["segment_spans"] = spans
     return state
 
 
 def node_match_commentary_spans(state: PipelineState) -> PipelineState:
-    """Extract spans from Rashi blocks (by is_span_end), match to commentary segments via embeddings, append to segment_spans."""
+    """
+    Match the Rashi spans align_segments extracted (by is_span_end) to commentary segments via
+    embeddings, append to segment_spans.
+    """
     blocks = state["blocks"]
     lines = state["lines"]
     streams = state["streams"]
     main_sid = next(iter(streams.keys()), "s0")
-    commentary_spans = extract_commentary_spans_from_blocks(blocks, lines)
-    matched = match_commentary_spans_to_streams(commentary_spans, streams, main_sid)
+    commentary_spans = state.get("commentary_spans")
+    if commentary_spans is None:
+        commentary_spans = extract_commentary_spans_from_blocks(
+            blocks, lines, _line_rank(state), state.get("rashi_block_ids")
+        )
+    matched = match_commentary_spans_to_streams(
+        commentary_spans, streams, main_sid, registry=state.get("embedding_registry")
+    )
     state["segment_spans"] = list(state.get("segment_spans") or []) + matched
     return state
 
 
 def node_boundary_cuts(state: PipelineState) -> PipelineState:
-    img = Image.open(state["page_png_path"]).convert("RGB")
+    img = _page_gray(state)
     failures = compute_boundary_cuts_for_spans(
         page_img=img,
         spans=state.get("segment_spans", []),
@@ -187,36 +301,127 @@ def route_after_validate(state: PipelineState) -> str:
 
 
 def node_pause_for_hitl(state: PipelineState) -> PipelineState:
-    sid = state["session_id"]
-    sessions().update_one(
-        {"_id": sid},
-        {"$set": serialize_state(state), "$setOnInsert": {"_id": sid}},
-        upsert=True
-    )
+    save_session(state)
     return state
 
 
+def _persist_png_base64(doc: dict) -> str:
+    """
+    Page PNG for the persisted page: from the local render when it's still on disk (no
+    GridFS round trip), else from the session doc / GridFS. Never persist an empty image.
+    """
+    path = doc.get("page_png_path")
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            return base64.b64encode(f.read()).decode("ascii")
+    b64 = page_png_base64(doc)
+    if not b64:
+        raise RuntimeError(f"Page image unavailable for session {doc.get('session_id')}")
+    return b64
+
+
 def node_persist(state: PipelineState) -> PipelineState:
+    # Page id is assigned client-side so the page insert and the session snapshot
+    # come from one serialization, one write per collection
+    page_id = ObjectId()
+    state["persisted_page_id"] = str(page_id)
     doc = serialize_state(state)
-    page_doc = session_doc_to_tzuratlink_page(doc)
-    res = pages().insert_one(page_doc)
-    state["persisted_page_id"] = str(res.inserted_id)
+    page_doc = session_doc_to_tzuratlink_page({**doc, "base64_data": _persist_png_base64(doc)})
+    page_doc["_id"] = page_id
+    pages().insert_one(page_doc)
 
-    sid = state["session_id"]
-    sessions().update_one({"_id": sid}, {"$set": doc}, upsert=True)
+    save_session(state, doc)
     return state
 
 
-def serialize_state(state: PipelineState) -> dict:
-    def bbox_to_d(b): return {"x": b.x, "y": b.y, "w": b.w, "h": b.h}
+# Session snapshots can be rebuilt by re-running the graph; don't wait on the journal
+_SNAPSHOT_WC = WriteConcern(w=1, j=False)
+
+
+def save_session(state: PipelineState, doc: Optional[dict] = None) -> None:
+    """
+    Upsert the session doc, $set-ing only top-level fields that changed since the last
+    save of this state (everything on the first save). doc: serialize_state(state), if
+    the caller already has it.
+    """
+    sid = state["session_id"]
+    if doc is None:
+        doc = serialize_state(state)
+    prev = state.get("saved_session") or {}
+    to_set, to_unset = _session_delta(prev, doc)
+    if to_set or to_unset:
+        update = {"$setOnInsert": {"_id": sid}}
+        if to_set:
+            update["$set"] = to_set
+        if to_unset:
+            update["$unset"] = to_unset
+        coll = sessions().with_options(write_concern=_SNAPSHOT_WC)
+        new_png = to_set.get("page_png_gridfs_id") if to_set else None
+        if new_png:
+            # A re-run of the session uploads a new page image; drop the one it replaces
+            before = coll.find_one_and_update(
+                {"_id": sid}, update, upsert=True, projection={"page_png_gridfs_id": 1}
+            )
+            old_png = (before or {}).get("page_png_gridfs_id")
+            if old_png and old_png != new_png:
+                _delete_page_png(old_png)
+        else:
+            coll.update_one({"_id": sid}, update, upsert=True)
+    state["saved_session"] = doc
+
+
+def _delete_page_png(file_id: str) -> None:
+    try:
+        page_images().delete(ObjectId(file_id))
+    except (InvalidId, NoFile, PyMongoError):
+        pass  # best effort: an orphaned file only costs storage
+
+
+def _session_delta(prev: dict, doc: dict) -> Tuple[dict, dict]:
+    """
+    ($set, $unset) turning prev into doc. Keyed maps (blocks, lines, streams) are diffed
+    per entry, e.g. only "lines.<lid>" for lines that changed; other fields go whole.
+    """
+    to_set: dict = {}
+    to_unset: dict = {}
+    for k, v in doc.items():
+        pv = prev.get(k)
+        if k in prev and pv == v:
+            continue
+        if (
+            isinstance(v, dict) and isinstance(pv, dict) and v and pv
+            and all("." not in sk and not sk.startswith("$") for sk in (*v, *pv))
+        ):
+            for sk, sv in v.items():
+                if sk not in pv or pv[sk] != sv:
+                    to_set[f"{k}.{sk}"] = sv
+            for sk in pv:
+                if sk not in v:
+                    to_unset[f"{k}.{sk}"] = ""
+        else:
+            to_set[k] = v
+    return to_set, to_unset
+
 
+def _bbox_doc(b) -> dict:
+    return {"x": b.x, "y": b.y, "w": b.w, "h": b.h}
+
+
+def serialize_state(state: PipelineState) -> dict:
+    # Literal dict displays over slotted attributes are the cheapest form here
+    # (measured faster than attrgetter + dict(zip(keys, ...)))
     out = dict(state)
+    out.pop("embedding_registry", None)  # in-memory only
+    out.pop("commentary_spans", None)
+    out.pop("saved_session", None)
+    out.pop("page_img", None)
+    out.pop("page_gray", None)
 
     blocks = out.get("blocks") or {}
     out["blocks"] = {
         bid: {
             "block_id": blk.block_id,
-            "bbox": bbox_to_d(blk.bbox),
+            "bbox": _bbox_doc(blk.bbox),
             "line_ids": blk.line_ids,
             "font": blk.font,
             "assigned_stream_id": blk.assigned_stream_id,
@@ -230,7 +435,7 @@ def serialize_state(state: PipelineState) -> dict:
         lid: {
             "line_id": ln.line_id,
             "block_id": ln.block_id,
-            "bbox": bbox_to_d(ln.bbox),
+            "bbox": _bbox_doc(ln.bbox),
             "order_hint": ln.order_hint,
             "tess_text_weak": ln.tess_text_weak,
             "vlm_text": ln.vlm_text,
@@ -267,16 +472,51 @@ def serialize_state(state: PipelineState) -> dict:
         for sp in spans
     ]
 
-    # tzuratlink-data compatibility: store base64 image for finalize/page export
-    if out.get("page_png_path") and os.path.isfile(out["page_png_path"]):
+    # Page image goes to GridFS once; the session doc only carries its id
+    if (
+        not out.get("page_png_gridfs_id")
+        and out.get("page_png_path")
+        and os.path.isfile(out["page_png_path"])
+    ):
         try:
             with open(out["page_png_path"], "rb") as f:
-                out["base64_data"] = base64.b64encode(f.read()).decode("utf-8")
-        except OSError:
+                file_id = page_images().upload_from_stream(os.path.basename(out["page_png_path"]), f)
+            out["page_png_gridfs_id"] = state["page_png_gridfs_id"] = str(file_id)
+        except (OSError, PyMongoError):
             pass
     return out
 
 
+_B64_CHUNK = 3 << 18  # 768 KB
+
+
+def page_png_base64(doc: dict) -> str:
+    """
+    Page PNG as base64 for tzuratlink-data page export / the UI: inline base64_data
+    (older session docs) or fetched from GridFS by page_png_gridfs_id.
+    """
+    if doc.get("base64_data"):
+        return doc["base64_data"]
+    file_id = doc.get("page_png_gridfs_id")
+    if not file_id:
+        return ""
+    try:
+        stream = page_images().open_download_stream(ObjectId(file_id))
+        # Encode chunk by chunk instead of holding the raw PNG and its base64 together;
+        # only whole 3-byte groups are encoded until the end, so no padding mid-stream
+        buf = bytearray()
+        carry = b""
+        while chunk := stream.read(_B64_CHUNK):
+            data = carry + chunk
+            cut = len(data) - len(data) % 3
+            buf += base64.b64encode(memoryview(data)[:cut])
+            carry = data[cut:]
+        buf += base64.b64encode(carry)
+        return buf.decode("ascii")
+    except (NoFile, PyMongoError):
+        return ""
+
+
 def build_graph():
     g = StateGraph(PipelineState)
 
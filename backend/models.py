@@ -1,27 +1,29 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
-from typing import List, Optional, Dict, Literal, TypedDict, Tuple
+from typing import Any, List, Optional, Dict, Literal, TypedDict, Tuple
 
-@dataclass
+@dataclass(slots=True)
 class BBox:
     x: int
     y: int
     w: int
     h: int
 
-@dataclass
+@dataclass(slots=True)
 class Line:
     line_id: str
     block_id: str
     bbox: BBox
-    order_hint: float
+    # Reading-order sort key: (y << 20) | x as an int from layout; Rashi split segments add
+    # idx * 0.0001 to their parent's key (float) so they sort right after it
+    order_hint: int | float
     tess_text_weak: Optional[str] = None
     vlm_text: Optional[str] = None
     vlm_conf: Optional[float] = None
     is_span_end: bool = False
     rashi_tess_text: Optional[str] = None
 
-@dataclass
+@dataclass(slots=True)
 class Block:
     block_id: str
     bbox: BBox
@@ -30,7 +32,7 @@ class Block:
     assigned_stream_id: Optional[str] = None
     assign_score: Optional[float] = None
 
-@dataclass
+@dataclass(slots=True)
 class Stream:
     stream_id: str
     title: str
@@ -38,7 +40,7 @@ class Stream:
     seg_refs: List[str] = field(default_factory=list)
     seg_texts: List[str] = field(default_factory=list)
 
-@dataclass
+@dataclass(slots=True)
 class SegmentSpan:
     stream_id: str
     seg_ref: str
@@ -56,11 +58,22 @@ class PipelineState(TypedDict, total=False):
     base_ref_range: str
 
     page_png_path: str
+    # GridFS id of the uploaded page PNG (set once by serialize_state)
+    page_png_gridfs_id: Optional[str]
+    # Decoded RGB page (PIL.Image) from render_page (in-memory only; not serialized)
+    page_img: Any
+    # Grayscale copy of page_img for Tesseract crops (in-memory only; not serialized)
+    page_gray: Any
     page_image_w: int
     page_image_h: int
 
     blocks: Dict[str, Block]
     lines: Dict[str, Line]
+    # Line ids in reading order, fixed once split_rashi_lines has run
+    sorted_line_ids: List[str]
+    # Block ids by font, fixed once classify_block_font has run
+    rashi_block_ids: List[str]
+    hebrew_block_ids: List[str]
 
     streams: Dict[str, Stream]
 
@@ -68,9 +81,16 @@ class PipelineState(TypedDict, total=False):
     unassigned_stream_ids: List[str]
 
     segment_spans: List[SegmentSpan]
+    # Rashi spans (start_line_id, end_line_id, text), extracted once by align_segments
+    # for match_commentary_spans (in-memory only; not serialized)
+    commentary_spans: List[Tuple[str, str, str]]
+    # embeddings.EmbeddingRegistry for the page (in-memory only; not serialized)
+    embedding_registry: Any
     boundary_cut_failures: List[Tuple[str, str]]
 
     validation_flags: List[str]
     needs_human_review: bool
 
     persisted_page_id: Optional[str]
+    # Last session doc written to Mongo, for delta updates (in-memory only; not serialized)
+    saved_session: Dict[str, Any]
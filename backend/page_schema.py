@@ -7,6 +7,8 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Any, Dict, List
 
+import numpy as np
+
 
 def _page_ref_from_base_ref_range(base_ref_range: str) -> str:
     """e.g. 'Berakhot 2a:1-6' -> 'Berakhot 2a', 'Berakhot 2a' -> 'Berakhot 2a'."""
@@ -22,18 +24,32 @@ def _segment_spans_to_bboxes(
     segment_spans: List[Dict[str, Any]],
     page_w: int,
     page_h: int,
+    sorted_line_ids: List[str] | None = None,
 ) -> List[Dict[str, Any]]:
     """
     Build tzuratlink-data bboxes from segment_spans + lines.
     One bbox per line per segment (multiple bboxes per ref allowed).
     Normalized: top, left, width, height in [0, 1].
+    sorted_line_ids: reading order saved with the session; re-sorted if absent or stale.
     """
     if not lines or page_w <= 0 or page_h <= 0:
         return []
 
-    sorted_line_ids = sorted(lines.keys(), key=lambda lid: lines[lid].get("order_hint", 0))
+    if not sorted_line_ids or len(sorted_line_ids) != len(lines) or not all(
+        lid in lines for lid in sorted_line_ids
+    ):
+        sorted_line_ids = sorted(lines.keys(), key=lambda lid: lines[lid].get("order_hint", 0))
     line_id_to_index = {lid: i for i, lid in enumerate(sorted_line_ids)}
 
+    # Line geometry as arrays in reading order; per-span work is then slicing + one divide
+    n = len(sorted_line_ids)
+    boxes = [(lines[lid] or {}).get("bbox") for lid in sorted_line_ids]
+    has_box = np.fromiter((b is not None for b in boxes), dtype=bool, count=n)
+    xs, ys, ws, hs = (
+        np.fromiter((int(b.get(k, 0)) if b is not None else 0 for b in boxes), dtype=np.int64, count=n)
+        for k in ("x", "y", "w", "h")
+    )
+
     bboxes: List[Dict[str, Any]] = []
     for sp in segment_spans:
         seg_ref = sp.get("seg_ref")
@@ -44,40 +60,31 @@ def _segment_spans_to_bboxes(
         if not seg_ref or start_id not in line_id_to_index or end_id not in line_id_to_index:
             continue
 
-        i_start = line_id_to_index[start_id]
-        i_end = line_id_to_index[end_id]
-        line_ids_in_span = sorted_line_ids[i_start : i_end + 1]
-
-        for i, lid in enumerate(line_ids_in_span):
-            ln = lines.get(lid)
-            if not ln or "bbox" not in ln:
-                continue
-            b = ln["bbox"]
-            x = int(b.get("x", 0))
-            y = int(b.get("y", 0))
-            w = int(b.get("w", 0))
-            h = int(b.get("h", 0))
-
-            is_last_line = lid == end_id
-            if is_last_line and end_cut_x is not None:
-                right = min(x + w, int(end_cut_x))
-                w = max(0, right - x)
-
-            if w <= 0 or h <= 0:
-                continue
-
-            top = y / page_h
-            left = x / page_w
-            width = w / page_w
-            height = h / page_h
-            bboxes.append({
-                "ref": seg_ref,
-                "top": round(top, 6),
-                "left": round(left, 6),
-                "width": round(width, 6),
-                "height": round(height, 6),
-            })
+        sl = slice(line_id_to_index[start_id], line_id_to_index[end_id] + 1)
+        x, y, h = xs[sl], ys[sl], hs[sl]
+        w = ws[sl].copy()
+        if w.size and end_cut_x is not None:
+            # Only the span's last line is clipped at the cut
+            w[-1] = max(0, min(x[-1] + w[-1], int(end_cut_x)) - x[-1])
 
+        keep = has_box[sl] & (w > 0) & (h > 0)
+        if not keep.any():
+            continue
+        # Divide in NumPy, round in Python: np.round can differ from round() in the last digit
+        tops = (y[keep] / page_h).tolist()
+        lefts = (x[keep] / page_w).tolist()
+        widths = (w[keep] / page_w).tolist()
+        heights = (h[keep] / page_h).tolist()
+        bboxes.extend(
+            {
+                "ref": seg_ref,
+                "top": round(t, 6),
+                "left": round(l, 6),
+                "width": round(wd, 6),
+                "height": round(ht, 6),
+            }
+            for t, l, wd, ht in zip(tops, lefts, widths, heights)
+        )
     return bboxes
 
 
@@ -85,7 +92,8 @@ def session_doc_to_tzuratlink_page(session_doc: Dict[str, Any]) -> Dict[str, Any
     """
     Convert a session document (from DB or serialize_state) to tzuratlink-data Page schema.
     Session doc must have: pdf_url, base_ref_range, lines, segment_spans, page_image_w, page_image_h.
-    Session doc should have base64_data (set by serialize_state when page_png_path exists).
+    Session doc should have base64_data (callers fill it via graph.page_png_base64; the session
+    itself stores the PNG in GridFS).
     """
     now = datetime.utcnow()
     ref = _page_ref_from_base_ref_range(session_doc.get("base_ref_range", ""))
@@ -97,7 +105,9 @@ def session_doc_to_tzuratlink_page(session_doc: Dict[str, Any]) -> Dict[str, Any
     lines = session_doc.get("lines") or {}
     segment_spans = session_doc.get("segment_spans") or []
 
-    bboxes = _segment_spans_to_bboxes(lines, segment_spans, page_w, page_h)
+    bboxes = _segment_spans_to_bboxes(
+        lines, segment_spans, page_w, page_h, session_doc.get("sorted_line_ids")
+    )
 
     return {
         "ref": ref,
@@ -1,26 +1,65 @@
 from __future__ import annotations
 
+import hashlib
 import os
 import re
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PDF_CACHE_DIR = "/tmp/pdf_cache"
+DOWNLOAD_CHUNK = 1 << 22  # 4 MB
+
+# One session (keep-alive + TLS reuse) for all downloads, with retries on transient errors
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+    ),
+)
+_SESSION.mount("http://", _SESSION.get_adapter("https://"))
 
 def is_http_url(s: str) -> bool:
     return bool(re.match(r"^https?://", s or ""))
 
 def ensure_local_pdf(pdf_url_or_path: str, session_id: str) -> str:
     """
-    If input is http(s), download to /tmp/<session_id>.pdf
+    If input is http(s), download to /tmp/pdf_cache/<sha256(url)>.pdf, shared by every
+    session for that URL; a cached copy is revalidated with If-None-Match (ETag).
     Else, return as-is (must exist inside container).
     """
     if is_http_url(pdf_url_or_path):
-        out = f"/tmp/{session_id}.pdf"
-        with requests.get(pdf_url_or_path, stream=True, timeout=60) as r:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        name = hashlib.sha256(pdf_url_or_path.encode("utf-8")).hexdigest()
+        out = os.path.join(PDF_CACHE_DIR, f"{name}.pdf")
+        etag_path = out + ".etag"
+
+        headers = {}
+        if os.path.exists(out) and os.path.exists(etag_path):
+            with open(etag_path, encoding="utf-8") as f:
+                headers["If-None-Match"] = f.read().strip()
+
+        with _SESSION.get(pdf_url_or_path, stream=True, timeout=60, headers=headers) as r:
+            if r.status_code == 304:
+                return out
             r.raise_for_status()
-            with open(out, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024 * 256):
+            # Write aside and rename, so concurrent sessions never read a partial file
+            tmp = f"{out}.{session_id}.{uuid.uuid4().hex}.part"
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
                     if chunk:
                         f.write(chunk)
+            os.replace(tmp, out)
+            etag = r.headers.get("ETag")
+        if etag:
+            with open(etag_path, "w", encoding="utf-8") as f:
+                f.write(etag)
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
         return out
 
     if not os.path.exists(pdf_url_or_path):
@@ -1,73 +1,224 @@
 """
 Rashi blocks: split lines by colon-words (vertical split at word left edge),
 order segments right-first, mark span ends, run Tesseract with rashi.tessdata.
+
+Tesseract runs once per block (PSM 6, uniform block of text) and its words are
+bucketed into the block's lines, instead of once per line crop.
 """
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 import pytesseract
 from PIL import Image
 
+try:
+    # In-process libtesseract: no CLI fork or model load per call
+    from tesserocr import PyTessBaseAPI, OEM, PSM, RIL, iterate_level
+except ImportError:  # fall back to the pytesseract CLI wrapper
+    PyTessBaseAPI = None
+
 from models import Block, Line, BBox
+from config import TESSERACT_WORKERS, TESSDATA_DIR
+
+# Long-lived OCR workers: with tesserocr each thread keeps its own initialized
+# TessBaseAPI per (lang, tessdata dir) across blocks and pages
+_POOL = ThreadPoolExecutor(max_workers=TESSERACT_WORKERS, thread_name_prefix="ocr")
+_local = threading.local()
 
 
-def _word_boxes_for_crop(img: Image.Image) -> List[Tuple[str, BBox]]:
-    """Word-level bboxes in crop-local coordinates (level=5)."""
-    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
-    out: List[Tuple[str, BBox]] = []
-    n = len(data["level"])
-    for i in range(n):
-        if data["level"][i] != 5:
+def _rashi_blocks(blocks: Dict[str, Block], rashi_block_ids: Optional[List[str]]) -> List[Block]:
+    """Rashi blocks, from the precomputed id list when the caller has one."""
+    if rashi_block_ids is None:
+        return [b for b in blocks.values() if b.font == "rashi"]
+    return [blocks[bid] for bid in rashi_block_ids if bid in blocks]
+
+
+def _line_for_point(cx: float, cy: float, block_lines: List[Line]) -> Optional[Line]:
+    """Line whose bbox contains the point; else the vertically nearest line spanning cx."""
+    best: Optional[Line] = None
+    best_d = None
+    for ln in block_lines:
+        b = ln.bbox
+        if not (b.x <= cx <= b.x + b.w):
             continue
-        txt = (data["text"][i] or "").strip()
+        if b.y <= cy <= b.y + b.h:
+            return ln
+        d = abs(cy - (b.y + b.h / 2))
+        if best_d is None or d < best_d:
+            best, best_d = ln, d
+    return best
+
+
+def _tess_api(lang: str, tessdata_dir: Optional[str]):
+    """
+    This thread's TessBaseAPI for (lang, tessdata_dir), initialized on first use;
+    None if it can't be initialized (e.g. missing traineddata), so callers fall back.
+    """
+    apis = getattr(_local, "apis", None)
+    if apis is None:
+        apis = _local.apis = {}
+    key = (lang, tessdata_dir)
+    api = apis.get(key)
+    if api is None:
+        # Default languages: apt's tessdata, not the prefix the tesserocr wheel was built with
+        path = tessdata_dir or (TESSDATA_DIR if os.path.isdir(TESSDATA_DIR) else None)
+        kwargs = {"path": path} if path else {}
+        try:
+            api = PyTessBaseAPI(lang=lang, oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_BLOCK, **kwargs)
+        except RuntimeError:
+            api = False  # remembered, so a broken setup isn't re-initialized per block
+        apis[key] = api
+    return api or None
+
+
+def _block_words(
+    crop: Image.Image, lang: Optional[str], tessdata_dir: Optional[str]
+) -> List[Tuple[str, int, int, int, int]]:
+    """Words in the crop as (text, left, top, width, height), in reading order (PSM 6)."""
+    api = _tess_api(lang or "eng", tessdata_dir) if PyTessBaseAPI is not None else None
+    if api is not None:
+        api.SetImage(crop)
+        api.Recognize()
+        it = api.GetIterator()
+        words: List[Tuple[str, int, int, int, int]] = []
+        if it is None:
+            return words
+        for r in iterate_level(it, RIL.WORD):
+            bb = r.BoundingBox(RIL.WORD)
+            if bb is None:
+                continue
+            x1, y1, x2, y2 = bb
+            words.append((r.GetUTF8Text(RIL.WORD) or "", x1, y1, x2 - x1, y2 - y1))
+        return words
+
+    config = f"--tessdata-dir {tessdata_dir} --psm 6" if tessdata_dir else "--psm 6"
+    data = pytesseract.image_to_data(crop, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+    return [
+        (data["text"][i] or "", data["left"][i], data["top"][i], data["width"][i], data["height"][i])
+        for i in range(len(data["level"]))
+        if data["level"][i] == 5
+    ]
+
+
+def _ocr_block(
+    page_img: Image.Image,
+    block: Block,
+    lines: Dict[str, Line],
+    lang: Optional[str] = None,
+    tessdata_dir: Optional[str] = None,
+    pad: int = 2,
+) -> Dict[str, List[Tuple[str, BBox]]]:
+    """
+    One Tesseract pass over the block crop; returns {line_id: [(word, page-coords bbox)]}
+    for the block's lines, words in Tesseract reading order.
+    """
+    block_lines = [lines[lid] for lid in block.line_ids if lid in lines]
+    out: Dict[str, List[Tuple[str, BBox]]] = {ln.line_id: [] for ln in block_lines}
+    if not block_lines:
+        return out
+
+    x0 = max(0, block.bbox.x - pad)
+    y0 = max(0, block.bbox.y - pad)
+    x1 = min(page_img.width, block.bbox.x + block.bbox.w + pad)
+    y1 = min(page_img.height, block.bbox.y + block.bbox.h + pad)
+    crop = page_img.crop((x0, y0, x1, y1))
+
+    for text, left, top, width, height in _block_words(crop, lang, tessdata_dir):
+        txt = text.strip()
         if not txt:
             continue
-        out.append((txt, BBox(
-            x=int(data["left"][i]),
-            y=int(data["top"][i]),
-            w=int(data["width"][i]),
-            h=int(data["height"][i]),
-        )))
+        box = BBox(x=x0 + int(left), y=y0 + int(top), w=int(width), h=int(height))
+        ln = _line_for_point(box.x + box.w / 2, box.y + box.h / 2, block_lines)
+        if ln is not None:
+            out[ln.line_id].append((txt, box))
     return out
 
 
-def _split_points_for_line(line: Line, crop: Image.Image) -> List[int]:
-    """Left-edge x (page coords) of every word that ends with ':' in this line crop."""
-    word_boxes = _word_boxes_for_crop(crop)
-    line_x = line.bbox.x
+def _ocr_many(fn: Callable, items: List) -> List:
+    """
+    Map an OCR call over items (blocks) on the shared worker pool. Both tesserocr (GIL
+    released during recognition) and pytesseract (a subprocess) run in parallel on threads.
+    """
+    return list(_POOL.map(fn, items))
+
+
+def _split_points_for_line(line: Line, word_boxes: List[Tuple[str, BBox]]) -> List[int]:
+    """
+    Left-edge x (page coords) of every word in this line that ends with ':'.
+    Only interior cuts produce segments; a colon word at the line's left edge (RTL: the
+    comment ends with the line) marks the line itself as a span end instead.
+    """
     points: List[int] = []
     for txt, box in word_boxes:
         if (txt or "").rstrip().endswith(":"):
-            points.append(line_x + box.x)
-    return sorted(set(points))
+            points.append(box.x)
+    if any(p <= line.bbox.x for p in points):
+        line.is_span_end = True
+    return sorted({p for p in points if line.bbox.x < p < line.bbox.x + line.bbox.w})
+
+
+def _split_block_words(
+    page_img: Image.Image,
+    block: Block,
+    lines: Dict[str, Line],
+    lang: Optional[str],
+    tessdata_dir: Optional[str],
+) -> Tuple[Dict[str, List[Tuple[str, BBox]]], bool]:
+    """
+    Words for the split pass and whether they came from the Rashi model. A failing Rashi
+    model falls back to default Tesseract (split points only); if that fails too, no words.
+    """
+    if lang:
+        try:
+            return _ocr_block(page_img, block, lines, lang=lang, tessdata_dir=tessdata_dir), True
+        except Exception:
+            pass
+    try:
+        return _ocr_block(page_img, block, lines), False
+    except Exception:
+        return {}, False
 
 
 def split_rashi_lines(
     page_img: Image.Image,
     blocks: Dict[str, Block],
     lines: Dict[str, Line],
+    rashi_block_ids: Optional[List[str]] = None,
+    tessdata_dir: Optional[str] = None,
 ) -> None:
     """
     For each Rashi block, split every line at words ending with ':' (split at word left edge).
     Replace each such line with segment-lines ordered right-first; mark segments as span ends.
     Mutates blocks and lines in place.
+    With tessdata_dir, the split OCR runs with rashi.tessdata and its words also become each
+    (segment-)line's rashi_tess_text, so run_rashi_tesseract has nothing left to OCR.
+    OCR failures never raise: a block whose Rashi OCR failed is split from default Tesseract
+    words (or not at all) and keeps rashi_tess_text None for run_rashi_tesseract.
     """
-    for block in list(blocks.values()):
-        if block.font != "rashi":
-            continue
+    lang = "rashi" if tessdata_dir else None
+    rashi_blocks = _rashi_blocks(blocks, rashi_block_ids)
+    block_results = _ocr_many(
+        lambda b: _split_block_words(page_img, b, lines, lang, tessdata_dir),
+        rashi_blocks,
+    )
+
+    def words_text(words: List[Tuple[str, BBox]], x0: float, x1: float) -> str:
+        return " ".join(t for t, b in words if x0 <= b.x + b.w / 2 < x1)
+
+    for block, (words_by_lid, has_text) in zip(rashi_blocks, block_results):
         new_line_ids: List[str] = []
         for lid in block.line_ids:
             ln = lines.get(lid)
             if not ln:
                 continue
-            pad = 2
-            x0 = max(0, ln.bbox.x - pad)
-            y0 = max(0, ln.bbox.y - pad)
-            x1 = min(page_img.width, ln.bbox.x + ln.bbox.w + pad)
-            y1 = min(page_img.height, ln.bbox.y + ln.bbox.h + pad)
-            crop = page_img.crop((x0, y0, x1, y1))
-            split_xs = _split_points_for_line(ln, crop)
+            words = words_by_lid.get(lid, [])
+            split_xs = _split_points_for_line(ln, words)
             if not split_xs:
+                if has_text:
+                    ln.rashi_tess_text = words_text(words, float("-inf"), float("inf"))
                 new_line_ids.append(lid)
                 continue
             # Segments: [line.x, p1), [p1, p2), ..., [pk, line.x+line.w]
@@ -89,41 +240,57 @@ def split_rashi_lines(
                     order_hint=ln.order_hint + idx * 0.0001,
                     is_span_end=True,
                 )
+                if has_text:
+                    # Outer segments also take words whose centers fall just outside the line
+                    lo = float("-inf") if seg_x == ln.bbox.x else seg_x
+                    hi = float("inf") if seg_right == ln.bbox.x + ln.bbox.w else seg_right
+                    seg_line.rashi_tess_text = words_text(words, lo, hi)
                 lines[seg_id] = seg_line
                 new_line_ids.append(seg_id)
             del lines[lid]
         block.line_ids = new_line_ids
 
 
+def _block_line_texts(
+    page_img: Image.Image,
+    block: Block,
+    lines: Dict[str, Line],
+    lang: Optional[str] = None,
+    tessdata_dir: Optional[str] = None,
+) -> Optional[Dict[str, str]]:
+    """{line_id: text} from one block OCR pass; None if Tesseract failed."""
+    try:
+        words = _ocr_block(page_img, block, lines, lang=lang, tessdata_dir=tessdata_dir)
+    except Exception:
+        return None
+    return {lid: " ".join(t for t, _ in ws) for lid, ws in words.items()}
+
+
 def run_rashi_tesseract(
     page_img: Image.Image,
     blocks: Dict[str, Block],
     lines: Dict[str, Line],
     tessdata_dir: str,
+    rashi_block_ids: Optional[List[str]] = None,
 ) -> None:
     """
-    For every line in a Rashi block, run Tesseract with rashi.tessdata on the line crop
-    and set line.rashi_tess_text. Mutates lines in place.
+    For every Rashi block, run Tesseract with rashi.tessdata once on the block crop
+    and set each line's rashi_tess_text. Blocks whose lines all have text already
+    (from split_rashi_lines) are skipped. Mutates lines in place.
     """
-    config = f"--tessdata-dir {tessdata_dir}"
-    for block in blocks.values():
-        if block.font != "rashi":
-            continue
+    rashi_blocks = [
+        b for b in _rashi_blocks(blocks, rashi_block_ids)
+        if any(lid in lines and lines[lid].rashi_tess_text is None for lid in b.line_ids)
+    ]
+    results = _ocr_many(
+        lambda b: _block_line_texts(page_img, b, lines, lang="rashi", tessdata_dir=tessdata_dir),
+        rashi_blocks,
+    )
+    for block, texts in zip(rashi_blocks, results):
         for lid in block.line_ids:
             ln = lines.get(lid)
-            if not ln:
-                continue
-            pad = 2
-            x0 = max(0, ln.bbox.x - pad)
-            y0 = max(0, ln.bbox.y - pad)
-            x1 = min(page_img.width, ln.bbox.x + ln.bbox.w + pad)
-            y1 = min(page_img.height, ln.bbox.y + ln.bbox.h + pad)
-            crop = page_img.crop((x0, y0, x1, y1))
-            try:
-                text = pytesseract.image_to_string(crop, lang="rashi", config=config)
-                ln.rashi_tess_text = (text or "").strip()
-            except Exception:
-                ln.rashi_tess_text = None
+            if ln and ln.rashi_tess_text is None:
+                ln.rashi_tess_text = None if texts is None else texts.get(lid, "")
 
 
 def fill_line_text_from_tesseract(
@@ -133,24 +300,25 @@ def fill_line_text_from_tesseract(
 ) -> None:
     """
     Set vlm_text for every line from Tesseract only (no VLM).
-    Rashi lines: use existing rashi_tess_text. Hebrew lines: run default Tesseract on crop.
+    Rashi lines: use existing rashi_tess_text. Hebrew lines: default Tesseract, once per block.
     """
+    todo: List[Block] = []
     for block in blocks.values():
+        need_ocr = False
         for lid in block.line_ids:
             ln = lines.get(lid)
             if not ln:
                 continue
             if ln.rashi_tess_text is not None:
                 ln.vlm_text = ln.rashi_tess_text
-                continue
-            pad = 2
-            x0 = max(0, ln.bbox.x - pad)
-            y0 = max(0, ln.bbox.y - pad)
-            x1 = min(page_img.width, ln.bbox.x + ln.bbox.w + pad)
-            y1 = min(page_img.height, ln.bbox.y + ln.bbox.h + pad)
-            crop = page_img.crop((x0, y0, x1, y1))
-            try:
-                text = pytesseract.image_to_string(crop)
-                ln.vlm_text = (text or "").strip()
-            except Exception:
-                ln.vlm_text = None
+            else:
+                need_ocr = True
+        if need_ocr:
+            todo.append(block)
+
+    results = _ocr_many(lambda b: _block_line_texts(page_img, b, lines), todo)
+    for block, texts in zip(todo, results):
+        for lid in block.line_ids:
+            ln = lines.get(lid)
+            if ln and ln.rashi_tess_text is None:
+                ln.vlm_text = None if texts is None else texts.get(lid, "")
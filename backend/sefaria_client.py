@@ -1,18 +1,95 @@
 from __future__ import annotations
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Any, Dict, List, Tuple, DefaultDict
 from collections import defaultdict
-import requests
-from config import SEFARIA_BASE
+import httpx
+import orjson
+from pymongo.errors import PyMongoError
+from config import SEFARIA_BASE, SEFARIA_CACHE_TTL_DAYS
+from db import sefaria_cache
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_cache_index_ready = False
+
+# Pooled keep-alive connections to Sefaria (HTTP/2 when available, so concurrent
+# extract_streams_many fetches multiplex on one connection); gzip is negotiated by default
+_CLIENT = httpx.Client(
+    base_url=SEFARIA_BASE,
+    timeout=30,
+    transport=httpx.HTTPTransport(
+        http2=_HTTP2,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        retries=3,  # connect errors only
+    ),
+)
+# Transient HTTP statuses and transport errors (timeouts, dropped connections) retried
+# with exponential backoff
+_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+_MAX_RETRIES = 3
 
 def _get_json(path: str, params: Dict | None = None) -> Dict:
-    url = f"{SEFARIA_BASE}{path}"
-    r = requests.get(url, params=params, timeout=30)
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            r = _CLIENT.get(path, params=params)
+        except httpx.TransportError:
+            if attempt == _MAX_RETRIES:
+                raise
+        else:
+            if r.status_code not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
+                break
+        time.sleep(0.3 * 2 ** attempt)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+def _normalize_ref(ref_range: str) -> str:
+    # Sefaria treats "_" and " " alike in refs
+    return " ".join((ref_range or "").replace("_", " ").split())
+
+def _ensure_cache_index() -> None:
+    global _cache_index_ready
+    if _cache_index_ready:
+        return
+    try:
+        sefaria_cache().create_index("at", expireAfterSeconds=SEFARIA_CACHE_TTL_DAYS * 86400)
+        _cache_index_ready = True
+    except PyMongoError:
+        pass
+
+@lru_cache(maxsize=1024)
+def _fetch_text_cached(ref: str) -> Dict[str, Any]:
+    """Process LRU in front of a Mongo TTL cache in front of Sefaria; cache errors fall through."""
+    _ensure_cache_index()
+    try:
+        doc = sefaria_cache().find_one({"_id": ref})
+        if doc and doc.get("payload"):
+            return orjson.loads(doc["payload"])
+    except (PyMongoError, orjson.JSONDecodeError):
+        pass
+
+    payload = _get_json(f"/api/texts/{ref}", params={"commentary": 1, "context": 0})
+    try:
+        # Stored as JSON bytes: payload keys are not guaranteed to be valid BSON field names
+        sefaria_cache().replace_one(
+            {"_id": ref},
+            {"payload": orjson.dumps(payload), "at": datetime.now(timezone.utc)},
+            upsert=True,
+        )
+    except PyMongoError:
+        pass
+    return payload
 
 def fetch_text_with_commentary(ref_range: str) -> Dict[str, Any]:
-    return _get_json(f"/api/texts/{ref_range}", params={"commentary": 1, "context": 0})
+    """Sefaria text + commentary for a ref range. Cached; treat the result as read-only."""
+    return _fetch_text_cached(_normalize_ref(ref_range))
 
 def extract_streams(
     ref_range: str,
@@ -41,7 +118,7 @@ def extract_streams(
     # v1 returns "refs" sometimes, and always has "ref" as a normalized ref string
     base_refs = payload.get("refs")
     if isinstance(base_refs, list) and len(base_refs) == len(base_segments):
-        refs = base_refs
+        refs = list(base_refs)  # payload is shared through the cache
     else:
         # If we can't match segment refs, fall back to normalized base ref + seg index
         base_ref_norm = payload.get("ref") or ref_range
@@ -54,9 +131,10 @@ def extract_streams(
     if not isinstance(comm, list) or not comm:
         return streams
 
-    # Group commentary link items into streams by a stable title
-    grouped_refs: DefaultDict[str, List[str]] = defaultdict(list)
-    grouped_texts: DefaultDict[str, List[str]] = defaultdict(list)
+    # Group commentary link items into streams by a stable title: (seg_refs, seg_texts)
+    grouped: DefaultDict[str, Tuple[List[str], List[str]]] = defaultdict(lambda: ([], []))
+    prefixes = tuple(commentary_title_prefixes)
+    keep: Dict[str, bool] = {}  # title -> passes the prefix filter
 
     for c in comm:
         if not isinstance(c, dict):
@@ -78,19 +156,37 @@ def extract_streams(
             title = _title_from_commentary_ref(cref)
 
         # Apply prefix filtering (same behavior you intended)
-        if not any(title.startswith(prefix) for prefix in commentary_title_prefixes):
+        ok = keep.get(title)
+        if ok is None:
+            ok = keep[title] = title.startswith(prefixes)
+        if not ok:
             continue
 
-        grouped_refs[title].append(cref)
-        grouped_texts[title].append(che)
+        seg_refs, seg_texts = grouped[title]
+        seg_refs.append(cref)
+        seg_texts.append(che)
 
-    # Emit grouped streams in deterministic order
-    for title in sorted(grouped_refs.keys()):
-        streams.append((title, grouped_refs[title], grouped_texts[title]))
+    # Emit grouped streams in first-seen order: the (cached) payload's link order is stable,
+    # so stream ids stay deterministic without sorting titles
+    for title, (seg_refs, seg_texts) in grouped.items():
+        streams.append((title, seg_refs, seg_texts))
 
     return streams
 
 
+def extract_streams_many(
+    ref_ranges: List[str],
+    commentary_title_prefixes: List[str] | None = None,
+    max_workers: int = 8,
+) -> List[List[Tuple[str, List[str], List[str]]]]:
+    """extract_streams for several ref ranges (batch page mode), fetched concurrently; input order."""
+    if len(ref_ranges) <= 1:
+        return [extract_streams(r, commentary_title_prefixes) for r in ref_ranges]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(ref_ranges))) as ex:
+        return list(ex.map(lambda r: extract_streams(r, commentary_title_prefixes), ref_ranges))
+
+
+@lru_cache(maxsize=4096)
 def _title_from_commentary_ref(cref: str) -> str:
     """
     Best-effort title from a commentary ref.
@@ -118,22 +214,20 @@ def _title_from_commentary_ref(cref: str) -> str:
 
 def _flatten_segments(he_obj: Any) -> List[str]:
     """
-    Recursive flatten:
+    Depth-first flatten with an explicit stack (no recursion limit):
     - string -> [string]
-    - nested lists -> all strings, depth-agnostic
+    - nested lists -> all strings, depth-agnostic, in document order
     """
     out: List[str] = []
-
-    def rec(x: Any) -> None:
+    stack: List[Any] = [he_obj]
+    while stack:
+        x = stack.pop()
         if isinstance(x, str):
             s = x.strip()
             if s:
                 out.append(s)
         elif isinstance(x, list):
-            for y in x:
-                rec(y)
-
-    rec(he_obj)
+            stack.extend(reversed(x))
     return out
 
 def _make_fallback_seg_refs(ref_range: str, n: int) -> List[str]:
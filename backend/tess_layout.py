@@ -1,20 +1,13 @@
 from __future__ import annotations
 
 from typing import Dict
+import numpy as np
 import pytesseract
 from PIL import Image
 
 from models import Block, Line, BBox
 
 
-def _bbox_intersects_vertically(a: BBox, b: BBox) -> bool:
-    return not (a.x + a.w <= b.x or b.x + b.w <= a.x)
-
-
-def _bbox_intersects_horizontally(a: BBox, b: BBox) -> bool:
-    return not (a.y + a.h <= b.y or b.y + b.h <= a.y)
-
-
 def _filter_margin_blocks(
     blocks: Dict[str, Block], lines: Dict[str, Line]
 ) -> tuple[Dict[str, Block], Dict[str, Line]]:
@@ -25,15 +18,23 @@ def _filter_margin_blocks(
        horizontal strip = y-overlap), but ONLY if those blocks are likely margin:
          - in left/right/top margin zone, OR
          - very small area
+    Mutates blocks and lines in place; returns them for convenience.
     """
     if len(blocks) <= 1:
         return blocks, lines
 
+    bids = list(blocks)
     block_list = list(blocks.values())
+    xs = np.fromiter((b.bbox.x for b in block_list), dtype=np.int64, count=len(block_list))
+    ys = np.fromiter((b.bbox.y for b in block_list), dtype=np.int64, count=len(block_list))
+    ws = np.fromiter((b.bbox.w for b in block_list), dtype=np.int64, count=len(block_list))
+    hs = np.fromiter((b.bbox.h for b in block_list), dtype=np.int64, count=len(block_list))
+    rights = xs + ws
+    bottoms = ys + hs
 
     # Estimate page size from bboxes (works even if caller doesn't pass image size)
-    page_w = max((b.bbox.x + b.bbox.w) for b in block_list)
-    page_h = max((b.bbox.y + b.bbox.h) for b in block_list)
+    page_w = int(rights.max())
+    page_h = int(bottoms.max())
     if page_w <= 0 or page_h <= 0:
         return blocks, lines
 
@@ -44,104 +45,102 @@ def _filter_margin_blocks(
     small_area_thr = 0.002 * page_w * page_h # tiny blocks are likely headers/folio/page marks
 
     # Prefer seeds from the top band; fallback to all blocks if none qualify
-    top_candidates = [b for b in block_list if b.bbox.y < top_band_h]
-    if not top_candidates:
-        top_candidates = block_list
+    cand = np.flatnonzero(ys < top_band_h)
+    if cand.size == 0:
+        cand = np.arange(len(block_list))
+
+    def _seed(edge: np.ndarray) -> BBox:
+        # First candidate at the edge extreme, then topmost (min() tie order)
+        at_edge = cand[edge[cand] == edge[cand].min()]
+        return block_list[at_edge[np.argmin(ys[at_edge])]].bbox
 
     # Left-top seed: leftmost, then topmost (within top band)
-    left_top = min(top_candidates, key=lambda b: (b.bbox.x, b.bbox.y))
+    left_top = _seed(xs)
 
     # Right-top seed: by right edge, then topmost (within top band)
-    right_top = min(top_candidates, key=lambda b: (-(b.bbox.x + b.bbox.w), b.bbox.y))
-
-    def _in_left_margin(bb: BBox) -> bool:
-        return bb.x < margin_x
-
-    def _in_right_margin(bb: BBox) -> bool:
-        return (bb.x + bb.w) > (page_w - margin_x)
-
-    def _in_top_margin(bb: BBox) -> bool:
-        return bb.y < margin_y
-
-    def _is_small(bb: BBox) -> bool:
-        return (bb.w * bb.h) < small_area_thr
-
-    def _is_margin_like(bb: BBox) -> bool:
-        # Only delete blocks that are plausibly margin junk.
-        return _in_left_margin(bb) or _in_right_margin(bb) or _in_top_margin(bb) or _is_small(bb)
-
-    to_remove: set[str] = set()
-
-    for bid, block in blocks.items():
-        bb = block.bbox
-
-        # Keep obviously non-margin blocks even if they align with a seed strip
-        if not _is_margin_like(bb):
-            continue
-
+    right_top = _seed(-rights)
+
+    # Only delete blocks that are plausibly margin junk: in the left/right/top margin zone, or tiny.
+    # Obviously non-margin blocks are kept even if they align with a seed strip.
+    margin_like = (
+        (xs < margin_x)
+        | (rights > page_w - margin_x)
+        | (ys < margin_y)
+        | (ws * hs < small_area_thr)
+    )
+
+    def _hits(seed: BBox) -> np.ndarray:
         # "Intersects vertically": x-overlap with seed strip
         # "Intersects horizontally": y-overlap with seed strip
-        hit_left = _bbox_intersects_vertically(bb, left_top.bbox) or _bbox_intersects_horizontally(bb, left_top.bbox)
-        hit_right = _bbox_intersects_vertically(bb, right_top.bbox) or _bbox_intersects_horizontally(bb, right_top.bbox)
+        x_overlap = (xs < seed.x + seed.w) & (rights > seed.x)
+        y_overlap = (ys < seed.y + seed.h) & (bottoms > seed.y)
+        return x_overlap | y_overlap
+
+    remove_mask = margin_like & (_hits(left_top) | _hits(right_top))
+    to_remove: set[str] = {bids[i] for i in np.flatnonzero(remove_mask)}
 
-        if hit_left or hit_right:
-            to_remove.add(bid)
+    if not to_remove:
+        return blocks, lines
 
-    new_blocks = {bid: b for bid, b in blocks.items() if bid not in to_remove}
-    new_lines = {lid: ln for lid, ln in lines.items() if ln.block_id not in to_remove}
+    # Drop in place: no rebuilt dicts or re-hashed surviving keys
+    for bid in to_remove:
+        del blocks[bid]
+    for lid in [lid for lid, ln in lines.items() if ln.block_id in to_remove]:
+        del lines[lid]
 
-    for b in new_blocks.values():
-        b.line_ids = [lid for lid in b.line_ids if lid in new_lines]
+    for b in blocks.values():
+        b.line_ids = [lid for lid in b.line_ids if lid in lines]
 
-    return new_blocks, new_lines
+    return blocks, lines
 
 def filter_margin_blocks(
     blocks: Dict[str, Block], lines: Dict[str, Line]
 ) -> tuple[Dict[str, Block], Dict[str, Line]]:
-    """Public wrapper: remove margin blocks and their lines. Call before classify_block_font to save tokens."""
+    """
+    Public wrapper: remove margin blocks and their lines (in place). Call before classify_block_font
+    to save tokens.
+    """
     return _filter_margin_blocks(blocks, lines)
 
 
-def _order_hint(b: BBox) -> float:
-    return b.y * 1_000_000 + b.x
+def _order_hint(b: BBox) -> int:
+    # Row-major integer key: y in the high bits, x (< 2**20 px) in the low 20
+    return (b.y << 20) | b.x
 
-def extract_blocks_lines(png_path: str) -> tuple[Dict[str, Block], Dict[str, Line]]:
-    img = Image.open(png_path).convert("RGB")
+def extract_blocks_lines(page: str | Image.Image) -> tuple[Dict[str, Block], Dict[str, Line]]:
+    """page: PNG path or an already decoded page image (grayscale preferred)."""
+    img = Image.open(page) if isinstance(page, str) else page
+    if img.mode != "L":
+        # Tesseract binarizes from gray anyway; one channel is a third of the bytes to hand over
+        img = img.convert("L")
     data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
 
     blocks: Dict[str, Block] = {}
     lines: Dict[str, Line] = {}
 
-    n = len(data["level"])
-
-    for i in range(n):
-        if data["level"][i] != 2:
-            continue
-        block_num = data["block_num"][i]
+    # One int matrix over the parallel DICT lists; one pass over only the block (2) and
+    # line (4) rows, in Tesseract order (a block's row precedes its lines' rows)
+    level = np.asarray(data["level"])
+    keep = (level == 2) | (level == 4)
+    cols = np.column_stack(
+        [
+            np.asarray(data[k], dtype=np.int64)[keep]
+            for k in ("level", "block_num", "par_num", "line_num", "left", "top", "width", "height")
+        ]
+    )
+
+    for lv, block_num, par_num, line_num, x, y, w, h in cols.tolist():
         bid = f"b{block_num}"
-        bbox = BBox(
-            x=int(data["left"][i]),
-            y=int(data["top"][i]),
-            w=int(data["width"][i]),
-            h=int(data["height"][i]),
-        )
-        blocks[bid] = Block(block_id=bid, bbox=bbox, line_ids=[])
-
-    for i in range(n):
-        if data["level"][i] != 4:
+        bbox = BBox(x=x, y=y, w=w, h=h)
+        if lv == 2:
+            block = blocks.get(bid)
+            if block is None:
+                blocks[bid] = Block(block_id=bid, bbox=bbox, line_ids=[])
+            else:
+                block.bbox = bbox
             continue
-        block_num = data["block_num"][i]
-        par_num = data["par_num"][i]
-        line_num = data["line_num"][i]
-        bid = f"b{block_num}"
-        lid = f"l{block_num}_{par_num}_{line_num}"
 
-        bbox = BBox(
-            x=int(data["left"][i]),
-            y=int(data["top"][i]),
-            w=int(data["width"][i]),
-            h=int(data["height"][i]),
-        )
+        lid = f"l{block_num}_{par_num}_{line_num}"
         ln = Line(
             line_id=lid,
             block_id=bid,
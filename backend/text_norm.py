@@ -0,0 +1,24 @@
+"""
+Hebrew text normalization shared by alignment, boundary cuts and the embedding cache.
+"""
+from __future__ import annotations
+
+import re
+from functools import lru_cache
+
+# Drop niqqud/cantillation (U+0591..U+05C7, maqaf becomes a space) and fold final letters
+_HEBREW_CANON = str.maketrans(
+    {**dict.fromkeys(range(0x0591, 0x05C8)), 0x05BE: " ", **dict(zip("ךםןףץ", "כמנפצ"))}
+)
+_WS_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=65536)
+def normalize_hebrew(text: str) -> str:
+    """Canonical form for fuzzy matching and cache keys only: folded finals are not real spelling."""
+    return _WS_RE.sub(" ", (text or "").translate(_HEBREW_CANON)).strip()
+
+
+def normalize_whitespace(text: str) -> str:
+    """Whitespace-only normalization: the text as written, for the embedding model."""
+    return " ".join((text or "").split())
@@ -1,32 +1,251 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import io
+import json
+import random
+import threading
 import time
-from typing import List, Dict, Tuple, Literal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple, Literal
 
+import httpx
+import numpy as np
 from PIL import Image
-import time
 import math
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
+from pymongo.errors import PyMongoError
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    OPENAI_TIMEOUT_S,
+    OPENAI_MAX_RETRIES,
+    VLM_BATCH_SIZE,
+    VLM_CONCURRENCY,
+)
+from db import font_cache
 
-from config import OPENAI_API_KEY, OPENAI_MODEL, OPENAI_TIMEOUT_S, OPENAI_MAX_RETRIES
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
 DEFAULT_CONFIDENCE = 0.95
 
+Font = Literal["hebrew", "rashi"]
+
+PROMPT = (
+    "Classify the dominant script in this cropped block.\n"
+    "Answer exactly one word: hebrew or rashi.\n"
+    "hebrew = standard square Hebrew letters.\n"
+    "rashi = Rashi script used in commentaries.\n"
+    "If unsure, still choose the best of the two."
+)
+
+BATCH_PROMPT = (
+    "You will get {n} cropped blocks, numbered 1 to {n}.\n"
+    "For each block, classify the dominant script as hebrew or rashi.\n"
+    "hebrew = standard square Hebrew letters.\n"
+    "rashi = Rashi script used in commentaries.\n"
+    "If unsure, still choose the best of the two.\n"
+    'Reply with only a JSON array of {n} strings in block order, e.g. ["hebrew", "rashi"].'
+)
+
+# Safety thresholds to avoid 400 '$.input is invalid' due to empty/huge images
+MIN_W, MIN_H = 20, 20
+MAX_PIXELS = 2_000_000  # cap area to keep the data URL reasonable (tune if needed)
+MAX_SIDE = 1024  # script is recognizable well below this; larger crops only add upload bytes
+
+# Font results by perceptual hash of the crop: process LRU, written through to Mongo,
+# so HITL re-runs and re-processed pages don't pay for the same blocks again
+_FONT_CACHE_MAX = 4096
+_font_mem: "OrderedDict[str, Font]" = OrderedDict()
+_font_lock = threading.Lock()
+
+# One pooled transport for every VLM call in the process: concurrent batches multiplex
+# as HTTP/2 streams over a kept-alive TLS connection instead of handshaking per request
+_HTTP = httpx.Client(
+    http2=_HTTP2,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=OPENAI_TIMEOUT_S,
+)
+# One client for the process so its pool (and kept-alive connections) survive across pages
+_CLIENT = (
+    OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_S, http_client=_HTTP)
+    if OPENAI_API_KEY
+    else None
+)
+
 
 def _img_to_b64_png(img: Image.Image) -> str:
     buf = io.BytesIO()
-    img.save(buf, format="PNG", optimize=True)
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    # Fast zlib level: the bytes go straight into a data URL, size barely matters
+    img.save(buf, format="PNG", compress_level=1)
+    # b64encode reads the buffer in place (no getvalue() copy); base64 output is pure ASCII
+    return base64.b64encode(buf.getbuffer()).decode("ascii")
+
+
+def _crop_hash(img: Image.Image) -> str:
+    """
+    16x16 difference hash (256 bits) of the crop plus its size bucket, namespaced by model.
+    Identical re-renders hash identically; the size keeps small look-alike blocks apart.
+    """
+    g = np.asarray(img.convert("L").resize((17, 16), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits((g[:, 1:] > g[:, :-1]).ravel()).tobytes()
+    size = f"{img.width // 16}x{img.height // 16}"
+    return hashlib.sha1(f"{OPENAI_MODEL}|{size}|".encode() + bits).hexdigest()
+
+
+def _font_cache_get(keys: List[str]) -> Dict[str, Font]:
+    out: Dict[str, Font] = {}
+    with _font_lock:
+        for k in keys:
+            v = _font_mem.get(k)
+            if v is not None:
+                _font_mem.move_to_end(k)
+                out[k] = v
+    rest = [k for k in keys if k not in out]
+    if rest:
+        try:
+            found = {d["_id"]: d["font"] for d in font_cache().find({"_id": {"$in": rest}})}
+        except PyMongoError:
+            found = {}
+        _font_cache_put(found, persist=False)
+        out.update(found)
+    return out
+
+
+def _font_cache_put(fonts: Dict[str, Font], persist: bool = True) -> None:
+    if not fonts:
+        return
+    with _font_lock:
+        for k, v in fonts.items():
+            _font_mem[k] = v
+            _font_mem.move_to_end(k)
+        while len(_font_mem) > _FONT_CACHE_MAX:
+            _font_mem.popitem(last=False)
+    if persist:
+        try:
+            font_cache().insert_many(
+                [{"_id": k, "font": v} for k, v in fonts.items()], ordered=False
+            )
+        except PyMongoError:
+            # Duplicate keys from a concurrent writer (or cache outage) are harmless
+            pass
+
+
+def _block_data_url(img: Optional[Image.Image]) -> Optional[str]:
+    """PNG data URL for a block crop, or None if the crop is too small to classify."""
+    # ---- Validation: image must be present and non-trivial ----
+    if img is None:
+        return None
+    if getattr(img, "width", 0) < MIN_W or getattr(img, "height", 0) < MIN_H:
+        return None
+
+    # Ensure RGB (avoid odd modes causing encoding issues)
+    img2 = img.convert("RGB")
+
+    # ---- Validation: cap image size to prevent huge base64 data URLs ----
+    area = img2.width * img2.height
+    scale = min(math.sqrt(MAX_PIXELS / float(area)), MAX_SIDE / float(max(img2.width, img2.height)))
+    if scale < 1.0:
+        new_w = max(MIN_W, int(img2.width * scale))
+        new_h = max(MIN_H, int(img2.height * scale))
+        img2 = img2.resize((new_w, new_h), resample=Image.LANCZOS)
+
+    # Encode
+    b64 = _img_to_b64_png(img2)
+
+    # ---- Validation: base64 must be non-empty ----
+    if not b64 or len(b64) < 100:
+        return None
+    return f"data:image/png;base64,{b64}"
+
+
+def _parse_font(raw: str) -> Font:
+    # More robust parse: accept only exact labels (strip punctuation)
+    raw_clean = "".join(ch for ch in (raw or "").strip().lower() if ch.isalpha())
+    # If model didn't follow instruction, default to hebrew
+    return "rashi" if raw_clean == "rashi" else "hebrew"
+
+
+def _create_with_retries(client: OpenAI, content: List[dict], max_output_tokens: int) -> str:
+    last_err = None
+    for attempt in range(1, OPENAI_MAX_RETRIES + 1):
+        try:
+            resp = client.responses.create(
+                model=OPENAI_MODEL,
+                input=[{"role": "user", "content": content}],
+                max_output_tokens=max_output_tokens,
+            )
+            return resp.output_text or ""
+        except Exception as e:
+            last_err = e
+            if attempt < OPENAI_MAX_RETRIES:
+                delay = min(2 ** (attempt - 1), 8)
+                if isinstance(e, RateLimitError):
+                    # Concurrent workers hit the limit together; jitter spreads their retries
+                    delay *= 1 + random.random()
+                time.sleep(delay)
+    raise last_err
+
+
+def _classify_one(client: OpenAI, bid: str, data_url: str) -> Font:
+    try:
+        raw = _create_with_retries(
+            client,
+            [
+                {"type": "input_text", "text": PROMPT},
+                {"type": "input_image", "image_url": data_url},
+            ],
+            max_output_tokens=16,
+        )
+    except Exception as e:
+        raise RuntimeError(f"OpenAI block font failed for {bid}: {e}") from e
+    return _parse_font(raw)
+
+
+def _classify_batch(client: OpenAI, batch: List[Tuple[str, str]]) -> Dict[str, Font]:
+    """
+    One multi-image request for a batch of (block_id, data_url); falls back to one request
+    per block if the reply is not a JSON array with one label per block.
+    """
+    if len(batch) == 1:
+        bid, url = batch[0]
+        return {bid: _classify_one(client, bid, url)}
+
+    content: List[dict] = [{"type": "input_text", "text": BATCH_PROMPT.format(n=len(batch))}]
+    for i, (_, url) in enumerate(batch, start=1):
+        content.append({"type": "input_text", "text": f"Block {i}:"})
+        content.append({"type": "input_image", "image_url": url})
+
+    try:
+        raw = _create_with_retries(client, content, max_output_tokens=16 + 8 * len(batch))
+        text = raw.strip().strip("`").strip()
+        if text.startswith("json"):
+            text = text[4:]
+        labels = json.loads(text)
+        if not isinstance(labels, list) or len(labels) != len(batch):
+            raise ValueError(f"expected {len(batch)} labels, got {labels!r}")
+        return {bid: _parse_font(str(lab)) for (bid, _), lab in zip(batch, labels)}
+    except Exception:
+        with ThreadPoolExecutor(max_workers=min(VLM_CONCURRENCY, len(batch))) as ex:
+            fonts = list(ex.map(lambda item: _classify_one(client, *item), batch))
+        return {bid: f for (bid, _), f in zip(batch, fonts)}
 
 
 def vlm_classify_block_font(
     block_items: List[Tuple[str, Image.Image]],
-) -> Dict[str, Literal["hebrew", "rashi"]]:
+) -> Dict[str, Font]:
     """
     block_items: [(block_id, PIL_crop), ...]
     returns: { block_id: "hebrew" | "rashi" }
+    Blocks already seen (by crop hash) come from the font cache; the rest are sent
+    VLM_BATCH_SIZE crops per request.
     """
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY is required. Add it to .env and load with load_dotenv.")
@@ -35,91 +254,41 @@ def vlm_classify_block_font(
     if not isinstance(OPENAI_MODEL, str) or "4o" not in OPENAI_MODEL:
         raise RuntimeError(f"OPENAI_MODEL doesn't look like a vision-capable 4o model: {OPENAI_MODEL!r}")
 
-    client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_S)
-    out: Dict[str, Literal["hebrew", "rashi"]] = {}
-
-    prompt = (
-        "Classify the dominant script in this cropped block.\n"
-        "Answer exactly one word: hebrew or rashi.\n"
-        "hebrew = standard square Hebrew letters.\n"
-        "rashi = Rashi script used in commentaries.\n"
-        "If unsure, still choose the best of the two."
-    )
-
-    # Safety thresholds to avoid 400 '$.input is invalid' due to empty/huge images
-    MIN_W, MIN_H = 20, 20
-    MAX_PIXELS = 2_000_000  # cap area to keep the data URL reasonable (tune if needed)
-
+    out: Dict[str, Font] = {}
+    keys: Dict[str, str] = {}
     for bid, img in block_items:
-        # ---- Validation: image must be present and non-trivial ----
-        if img is None:
+        if img is None or getattr(img, "width", 0) < MIN_W or getattr(img, "height", 0) < MIN_H:
             out[bid] = "hebrew"
-            continue
+        else:
+            keys[bid] = _crop_hash(img)
 
-        if getattr(img, "width", 0) < MIN_W or getattr(img, "height", 0) < MIN_H:
-            out[bid] = "hebrew"
+    cached = _font_cache_get(list(set(keys.values())))
+    todo: List[Tuple[str, str]] = []
+    for bid, img in block_items:
+        if bid in out:
             continue
-
-        # Ensure RGB (avoid odd modes causing encoding issues)
-        img2 = img.convert("RGB")
-
-        # ---- Validation: cap image size to prevent huge base64 data URLs ----
-        area = img2.width * img2.height
-        if area > MAX_PIXELS:
-            scale = math.sqrt(MAX_PIXELS / float(area))
-            new_w = max(MIN_W, int(img2.width * scale))
-            new_h = max(MIN_H, int(img2.height * scale))
-            img2 = img2.resize((new_w, new_h), resample=Image.LANCZOS)
-
-        # Encode
-        b64 = _img_to_b64_png(img2)
-
-        # ---- Validation: base64 must be non-empty ----
-        if not b64 or len(b64) < 100:
-            out[bid] = "hebrew"
+        if keys[bid] in cached:
+            out[bid] = cached[keys[bid]]
             continue
+        url = _block_data_url(img)
+        if url is None:
+            out[bid] = "hebrew"
+        else:
+            todo.append((bid, url))
 
-        data_url = f"data:image/png;base64,{b64}"
-
-        last_err = None
-        for attempt in range(1, OPENAI_MAX_RETRIES + 1):
-            try:
-                resp = client.responses.create(
-                    model=OPENAI_MODEL,
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "input_text", "text": prompt},
-                                {"type": "input_image", "image_url": data_url},
-                            ],
-                        }
-                    ],
-                    max_output_tokens=16,
-                )
-
-                raw = (resp.output_text or "").strip().lower()
-
-                # More robust parse: accept only exact labels (strip punctuation)
-                raw_clean = "".join(ch for ch in raw if ch.isalpha())
-
-                if raw_clean == "rashi":
-                    out[bid] = "rashi"
-                elif raw_clean == "hebrew":
-                    out[bid] = "hebrew"
-                else:
-                    # If model didn't follow instruction, default (or you can retry with a stricter prompt)
-                    out[bid] = "hebrew"
-
-                break
-
-            except Exception as e:
-                last_err = e
-                if attempt < OPENAI_MAX_RETRIES:
-                    time.sleep(min(2 ** (attempt - 1), 8))
+    if todo:
+        client = _CLIENT
+        step = max(1, VLM_BATCH_SIZE)
+        batches = [todo[i : i + step] for i in range(0, len(todo), step)]
+        workers = min(VLM_CONCURRENCY, len(batches))
+        if workers <= 1:
+            results = [_classify_batch(client, b) for b in batches]
         else:
-            out[bid] = "hebrew"
-            if last_err:
-                raise RuntimeError(f"OpenAI block font failed for {bid}: {last_err}") from last_err
+            # Batches are independent; overlap their round-trips on the shared client
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                results = list(ex.map(lambda b: _classify_batch(client, b), batches))
+        for fonts in results:
+            out.update(fonts)
+            _font_cache_put({keys[bid]: f for bid, f in fonts.items()})
 
-    return out
\ No newline at end of file
+    return out
@@ -1,11 +1,10 @@
 from __future__ import annotations
 
 import base64
-import io
+import tempfile
 from typing import Any, Dict, List
 
 from flask import Flask, request, jsonify
-from PIL import Image
 import pytesseract
 
 app = Flask(__name__)
@@ -27,11 +26,14 @@ def ocr():
         if not lid or not b64:
             continue
         raw = base64.b64decode(b64.encode("utf-8"))
-        img = Image.open(io.BytesIO(raw)).convert("RGB")
 
         # Tesseract line OCR. This is only to make the beta runnable end-to-end.
         # Replace with your real recognizer later.
-        txt = pytesseract.image_to_string(img, lang="heb+eng").strip()
+        # The encoded bytes go to tesseract as a file as-is: no PIL decode + PNG re-encode.
+        with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
+            tmp.write(raw)
+            tmp.flush()
+            txt = pytesseract.image_to_string(tmp.name, lang=lang).strip()
         conf = 0.5 if txt else 0.1
 
         results.append({"id": lid, "text": txt, "confidence": conf})